@@ -1 +1 @@
-PYTHONPATH=. python3 src/battles.py
+PYTHONPATH=. python3 src/battles.py "$@"
@@ -58,8 +58,9 @@ class Army(Movable):
 
     def draw(self, renderer):
         if renderer.tactics_enabled:
-            renderer.draw_circle(self.color, self.pos, self.ANCHOR_RADIUS)
-            renderer.draw_circle(self.color, self.pos, self.ANCHOR_RADIUS, width=1)
+            pos = self.render_pos(renderer.interpolation)
+            renderer.draw_circle(self.color, pos, self.ANCHOR_RADIUS)
+            renderer.draw_circle(self.color, pos, self.ANCHOR_RADIUS, width=1)
         for form in self.formations:
             form.draw(renderer)
 
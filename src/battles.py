@@ -1,17 +1,25 @@
 """
 Main class with game loop
 """
+import argparse
+import fractions
 import itertools
 import copy
+import time
+import numpy
 import pygame
 from src.util import FrameTimer
 from src.graphics import Renderer, Colors
 from src.ui import Ui, Button
 from src.army import Army
+from src.movable import Movable
 from src.soldier import Soldier, Swordsperson, Archer, SoldierLoader
-from src.behavior import BehaviorTree, Blackboard
+from src.weapon import Sword, Arrow
+from src.behavior import BehaviorTree, Blackboard, TreeInstrumentation
 from src.formation import FormationLoader, Formation
 from src.influence import InfluenceMap
+from src.spatial import SoldierIndex, first_circle_hits
+from src.profiler import FrameProfiler
 
 
 class GameModes:
@@ -29,22 +37,30 @@ class GameModes:
 class Battles:
     """Main class for the game"""
     DEBUG = False
+    # Simulation ticks per second, independent of the frame rate
+    SIM_RATE = FrameTimer.DEFAULT_SIM_RATE
 
     WINDOW_TITLE = "Battle Demo"
     SCREEN_SIZE = (1800, 1000)
     BUTTON_SIZE = (100, 60)
     HELP_BOX_SIZE = (500, 800)
 
-    def __init__(self):
-        pygame.init()
-        self.renderer = Renderer(self.WINDOW_TITLE, self.SCREEN_SIZE)
-        self.ui = Ui(self.renderer)
+    def __init__(self, headless=False):
+        self.headless = headless
+        self.renderer = None
+        self.ui = None
+        if not headless:
+            pygame.init()
+            self.renderer = Renderer(self.WINDOW_TITLE, self.SCREEN_SIZE)
+            self.ui = Ui(self.renderer)
         self._running = True
         self._paused = False
         self._mode = GameModes.WATCH
         self.help_box = None
         self.armies = {}
         self.soldiers = {}
+        # Store slots of self.soldiers in order, made again once soldiers are added or removed
+        self._soldier_slots = None
         self.buttons = []
         self.active_army = None
         self.active_formation = None
@@ -54,6 +70,8 @@ class Battles:
         self.active_formation_template = FormationLoader.get_next_template()
         self.active_soldier_type = SoldierLoader.get_next_type()
         self.influence_map = InfluenceMap(self.SCREEN_SIZE, self.soldiers, self.armies)
+        self.profiler = FrameProfiler()
+        self.profiler.overlay_enabled = self.DEBUG
 
     def create_army(self, position):
         """Allocate a new army if possible"""
@@ -69,11 +87,12 @@ class Battles:
         return army
 
     def create_soldier(self, soldier_class, make_active=True):
-        """Allocate a new soldier of the given class"""
-        soldier = soldier_class()
+        """Allocate a new soldier of the given class, recycling a removed one if possible"""
+        soldier = Soldier.pool().acquire(soldier_class)
         if make_active:
             # Add to the list of soldiers
             self.soldiers[soldier.my_id] = soldier
+            self._soldier_slots = None
         soldier.army = self.active_army
         return soldier
 
@@ -94,59 +113,152 @@ class Battles:
                                            centered=True, display=False)
 
     def setup(self, create_default_army):
-        self.create_ui()
+        if not self.headless:
+            self.create_ui()
 
         if create_default_army:
             self.create_default_army()
 
     def run(self):
         """The main game loop"""
-        frame_timer = FrameTimer()
+        frame_timer = FrameTimer(self.SIM_RATE)
 
         while self._running:
             delta = frame_timer.next_frame()
-            if self.DEBUG:
-                frame_timer.print_fps()
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self._running = False
-                elif event.type == pygame.KEYUP:
-                    self.handle_keypress(event)
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    self.handle_mouse_click(event)
-
-            self.update(delta)
-            self.handle_interactions()
-            self.clean_up()
+
+            with self.profiler.phase(FrameProfiler.EVENTS):
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        self._running = False
+                    elif event.type == pygame.KEYUP:
+                        self.handle_keypress(event)
+                    elif event.type == pygame.MOUSEBUTTONUP:
+                        self.handle_mouse_click(event)
+
+            for _ in range(frame_timer.sim_ticks(delta)):
+                self.tick(frame_timer.sim_step)
+            self.renderer.interpolation = frame_timer.interpolation()
             self.draw()
+            self.profiler.end_frame()
 
+        self.influence_map.close()
         print("Quitting")
 
+    def tick(self, delta):
+        """Advance the simulation by one step"""
+        Movable.store().save_previous_state()
+        Soldier.store().save_previous_state()
+        with self.profiler.phase(FrameProfiler.ARMY_UPDATE):
+            self.update_armies(delta)
+        with self.profiler.phase(FrameProfiler.SOLDIER_UPDATE):
+            self.update_soldiers(delta)
+        with self.profiler.phase(FrameProfiler.INTERACTIONS):
+            self.handle_interactions()
+        with self.profiler.phase(FrameProfiler.CLEANUP):
+            self.clean_up()
+        with self.profiler.phase(FrameProfiler.INFLUENCE_UPDATE):
+            self.influence_map.update()
+
+    def run_headless(self, ticks, delta):
+        """Run the simulation for a fixed number of ticks as fast as possible.
+        Nothing is drawn and there is no frame rate cap.
+        Returns the wall clock seconds taken.
+        """
+        start = time.perf_counter()
+        for _ in range(ticks):
+            self.tick(delta)
+            self.profiler.end_frame()
+        elapsed = time.perf_counter() - start
+        self.influence_map.close()
+        return elapsed
+
+    def soldier_slots(self):
+        """Store slots of every soldier, in the order they were added"""
+        if self._soldier_slots is None:
+            self._soldier_slots = numpy.fromiter((soldier.slot for soldier in self.soldiers.values()),
+                                                 dtype=numpy.intp, count=len(self.soldiers))
+        return self._soldier_slots
+
+    def allocation_counts(self):
+        """How many soldiers and arrows have been constructed so far, rather than recycled"""
+        counts = dict(Soldier.pool().created)
+        counts["Arrow"] = Arrow.pool().created
+        return counts
+
+    def outcome(self):
+        """Summarize the state of each army: {army_id: (living soldiers, total health)}"""
+        summary = {army_id: (0, 0.0) for army_id in self.armies}
+        for soldier in self.soldiers.values():
+            if soldier.is_alive() and soldier.army.my_id in summary:
+                alive, health = summary[soldier.army.my_id]
+                summary[soldier.army.my_id] = (alive + 1, health + soldier.health)
+        return summary
+
+    def charge(self):
+        """Send every army towards the center of the field"""
+        for army in self.armies.values():
+            army.set_waypoint(self.SCREEN_SIZE[0] / 2, self.SCREEN_SIZE[1] / 2)
+
     def update(self, delta):
         """Propagate the update to everything.
         Delta is seconds since last update.
         """
-        # Refresh blackboard shared data
-        BehaviorTree.board()[Blackboard.SOLDIERS] = self.soldiers
-        BehaviorTree.board()[Blackboard.ARMIES] = self.armies
+        self.update_armies(delta)
+        self.update_soldiers(delta)
 
+    def update_armies(self, delta):
         for army in self.armies.values():
             army.update(delta)
 
-        for soldier in self.soldiers.values():
-            soldier.update(delta)
+    def update_soldiers(self, delta):
+        # Refresh blackboard shared data
+        BehaviorTree.board()[Blackboard.SOLDIERS] = self.soldiers
+        BehaviorTree.board()[Blackboard.ARMIES] = self.armies
+        BehaviorTree.board()[Blackboard.SOLDIER_INDEX] = SoldierIndex(self.soldiers.values())
+        BehaviorTree.board()[Blackboard.INFLUENCE] = self.influence_map
 
-        self.influence_map.update()
+        Soldier.update_all(self.soldiers.values(), delta)
+        Arrow.pool().update(delta)
 
     def handle_interactions(self):
-        """Check for interactions between soldiers"""
-        #TODO optimize
-        for soldier1 in self.soldiers.values():
-            for soldier2 in self.soldiers.values():
-                if soldier1 == soldier2:
-                    continue
-                soldier1.interact(soldier2)
+        """Resolve every hit of this tick in bulk.
+        Arrows in flight and the tips of swinging swords are each checked against all living soldiers
+        with one spatial query, so the cost follows the number of attacks instead of pairs of soldiers.
+        """
+        store = Soldier.store()
+        slots = self.soldier_slots()
+        slots = slots[store.health[slots] > 0]
+        radii = store.radius[slots]
+        # Soldiers without an army have NO_ARMY, the same as the owner of arrows nobody fired, anyone can hit them
+        armies = store.army[slots].astype(numpy.intp)
+        positions = store.pos[slots]
+
+        self.resolve_arrow_hits(slots, positions, radii, armies)
+        self.resolve_melee_hits(slots, positions, radii, armies)
+
+    @staticmethod
+    def resolve_arrow_hits(slots, positions, radii, armies):
+        """Check the paths of every arrow in flight against the living soldiers at once"""
+        pool = Arrow.pool()
+        if not len(pool):
+            return
+        rows, targets = pool.resolve_hits(positions, radii, armies)
+        Soldier.take_damage_all(slots[targets], pool.damage[rows])
+
+    @staticmethod
+    def resolve_melee_hits(slots, positions, radii, armies):
+        """Check the tips of every swinging sword against the living soldiers at once.
+        Each sword hits the closest enemy its tip is inside and stops swinging.
+        """
+        store = Soldier.store()
+        attackers = numpy.flatnonzero(Sword.swinging_all(store, slots))
+        if not attackers.size:
+            return
+        tips = Sword.tips(store, slots[attackers])
+        hits, targets = first_circle_hits(tips, tips, armies[attackers], positions, radii, armies)
+        hitting = slots[attackers[hits]]
+        Soldier.take_damage_all(slots[targets], numpy.full(len(hitting), Sword.DAMAGE))
+        Sword.deactivate_all(store, hitting)
 
     def clean_up(self):
         """Remove things that are dead"""
@@ -163,7 +275,14 @@ class Battles:
     def blank_slate(self):
         """Reset the game to a blank battlefield"""
         self.armies.clear()
+        for soldier in self.soldiers.values():
+            Soldier.pool().release(soldier)
         self.soldiers.clear()
+        self._soldier_slots = None
+        Arrow.pool().clear()
+        # Ids are reused from here on, so forget what the old soldiers were doing
+        BehaviorTree.board()[Blackboard.TARGET].clear()
+        BehaviorTree.board()[Blackboard.WAYPOINT].clear()
         Army.next_id = 0
         Soldier.next_id = 0
 
@@ -183,18 +302,27 @@ class Battles:
         """Draw everything in the game"""
         self.renderer.start_frame()
 
-        self.influence_map.draw(self.renderer)
+        with self.profiler.phase(FrameProfiler.INFLUENCE_DRAW):
+            self.influence_map.draw(self.renderer)
 
-        for soldier in self.soldiers.values():
-            soldier.draw(self.renderer)
+        with self.profiler.phase(FrameProfiler.SOLDIER_DRAW):
+            sprites = []
+            Soldier.add_all_sprites(self.soldier_slots(), sprites, self.renderer.atlas, self.renderer.interpolation)
+            # Arrows fly over everything
+            Arrow.add_all_sprites(sprites, self.renderer.atlas, self.renderer.interpolation)
+            self.renderer.draw_sprites(sprites)
 
-        for army in self.armies.values():
-            army.draw(self.renderer)
+        with self.profiler.phase(FrameProfiler.UI):
+            for army in self.armies.values():
+                army.draw(self.renderer)
+
+            self.ui.draw()
+            self.draw_cursor()
 
-        self.ui.draw()
-        self.draw_cursor()
+        self.profiler.draw(self.renderer)
 
-        self.renderer.end_frame()
+        with self.profiler.phase(FrameProfiler.PRESENT):
+            self.renderer.end_frame()
 
     def draw_cursor(self):
         """Draw things that are being placed under the cursor"""
@@ -261,13 +389,16 @@ class Battles:
     def remove_army(self, army_id):
         sldr_ids_to_remove = [sldr.my_id for sldr in self.soldiers.values() if sldr.army.my_id == army_id]
         for soldier_id in sldr_ids_to_remove:
-            del self.soldiers[soldier_id]
+            self.remove_soldier(soldier_id)
         del self.armies[army_id]
 
     def remove_soldier(self, soldier_id):
         soldier = self.soldiers[soldier_id]
         soldier.cleanup()
         del self.soldiers[soldier_id]
+        self._soldier_slots = None
+        BehaviorTree.board().forget(soldier)
+        Soldier.pool().release(soldier)
 
     def push_formation(self):
         """The formation button or key has been pressed"""
@@ -296,6 +427,8 @@ class Battles:
             self.toggle_influence()
         if event.key == pygame.K_t:
             self.toggle_tactics()
+        if event.key == pygame.K_F3:
+            self.profiler.toggle_overlay()
         if event.key == pygame.K_a:
             self.set_mode(GameModes.PLACE_ARMY)
         if event.key == pygame.K_f:
@@ -390,6 +523,7 @@ class Battles:
         if obj and isinstance(obj, Formation) and obj.army == self.active_army:
             if obj.add_soldier(self.active_soldier):
                 self.soldiers[self.active_soldier.my_id] = self.active_soldier
+                self._soldier_slots = None
                 self.active_soldier = None
                 return True
         return False
@@ -474,7 +608,68 @@ class Battles:
         army.formations[1].add_soldier(self.create_soldier(Archer))
 
 
+def parse_delta(text):
+    """Parse a tick length in seconds, fractions like 1/60 are allowed"""
+    try:
+        delta = float(fractions.Fraction(text))
+    except (ValueError, ZeroDivisionError) as exc:
+        raise argparse.ArgumentTypeError(f"invalid tick length: '{text}'") from exc
+    if delta <= 0:
+        raise argparse.ArgumentTypeError(f"tick length must be positive: '{text}'")
+    return delta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=Battles.WINDOW_TITLE)
+    parser.add_argument("--headless", action="store_true",
+                        help="run the simulation without a window and print the outcome")
+    parser.add_argument("--ticks", type=int, default=600, help="number of ticks to run when headless")
+    parser.add_argument("--dt", type=parse_delta, default=1 / 60, help="seconds per tick when headless")
+    parser.add_argument("--sim-rate", type=int, default=Battles.SIM_RATE,
+                        help="simulation ticks per second when running with a window")
+    parser.add_argument("--engine", choices=BehaviorTree.ENGINES, default=BehaviorTree.ENGINE,
+                        help="how behavior trees are run")
+    parser.add_argument("--charge", action="store_true",
+                        help="send the default armies towards each other")
+    parser.add_argument("--async-influence", action="store_true",
+                        help="compute the influence map on a worker thread")
+    parser.add_argument("--diffusion-interval", type=int, default=InfluenceMap.DIFFUSION_INTERVAL,
+                        help="diffuse the influence map every this many ticks, or sooner once soldiers moved enough")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="only redraw and present the parts of the window that changed")
+    parser.add_argument("--profile-ai", action="store_true",
+                        help="time every behavior tree node and print a report when done")
+    args = parser.parse_args()
+
+    BehaviorTree.ENGINE = args.engine
+    InfluenceMap.ASYNCHRONOUS = args.async_influence
+    InfluenceMap.DIFFUSION_INTERVAL = args.diffusion_interval
+    Renderer.DIRTY_RECTS = args.dirty_rects
+    if args.profile_ai:
+        TreeInstrumentation.enable()
+    Battles.SIM_RATE = args.sim_rate
+    battles = Battles(headless=args.headless)
+    battles.setup(True)
+    if args.charge:
+        battles.charge()
+    if not args.headless:
+        battles.run()
+        if args.profile_ai:
+            TreeInstrumentation.dump()
+        return
+
+    elapsed = battles.run_headless(args.ticks, args.dt)
+    print(f"{args.ticks} ticks of {args.dt:.4f}s in {elapsed:.2f}s ({args.ticks / elapsed:.1f} ticks/s)")
+    outcome = battles.outcome()
+    for army_id, (alive, health) in outcome.items():
+        print(f"Army {army_id}: {alive} soldiers alive, {health:.1f} total health")
+    standing = [army_id for army_id, (alive, _) in outcome.items() if alive]
+    if len(standing) == 1:
+        print(f"Army {standing[0]} wins")
+    if args.profile_ai:
+        print()
+        TreeInstrumentation.dump()
+
+
 if __name__ == "__main__":
-    BT = Battles()
-    BT.setup(True)
-    BT.run()
+    main()
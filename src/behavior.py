@@ -3,26 +3,75 @@ Implementation of behavior trees
 """
 
 import os
+import sys
 import json
+import time
+import numpy
+from pygame import Vector2
+from src.spatial import SoldierIndex
 
 
 class InvalidBehaviorTree(Exception):
     pass
 
 
+class TargetTable(dict):
+    """Soldier id -> the soldier it is targeting.
+    Also indexed the other way, so the soldiers targeting someone are found without a scan.
+    """
+    def __init__(self):
+        super(TargetTable, self).__init__()
+        # Targeted soldier -> ids of the soldiers targeting it
+        self._pursuers = {}
+
+    def __setitem__(self, sid, target):
+        self._unlink(sid)
+        super(TargetTable, self).__setitem__(sid, target)
+        self._pursuers.setdefault(target, set()).add(sid)
+
+    def __delitem__(self, sid):
+        self._unlink(sid)
+        super(TargetTable, self).__delitem__(sid)
+
+    def pop(self, sid, *default):
+        self._unlink(sid)
+        return super(TargetTable, self).pop(sid, *default)
+
+    def clear(self):
+        self._pursuers.clear()
+        super(TargetTable, self).clear()
+
+    def pursuers(self, target):
+        """Ids of the soldiers targeting the given soldier"""
+        return self._pursuers.get(target, ())
+
+    def _unlink(self, sid):
+        target = self.get(sid, None)
+        if target is None:
+            return
+        pursuers = self._pursuers[target]
+        pursuers.discard(sid)
+        if not pursuers:
+            del self._pursuers[target]
+
+
 class Blackboard:
     """Holds references to game objects needed by Behaviors"""
     SOLDIERS = "soldiers"
     ARMIES = "armies"
     TARGET = "target"
     WAYPOINT = "waypoint"
+    SOLDIER_INDEX = "soldier_index"
+    INFLUENCE = "influence"
 
     def __init__(self):
         self._bb = {
             Blackboard.SOLDIERS: {},
             Blackboard.ARMIES: {},
-            Blackboard.TARGET: {},
+            Blackboard.TARGET: TargetTable(),
             Blackboard.WAYPOINT: {},
+            Blackboard.SOLDIER_INDEX: SoldierIndex(()),
+            Blackboard.INFLUENCE: None,
         }
 
     def __getitem__(self, item):
@@ -37,9 +86,24 @@ class Blackboard:
             return None
         return parent.get(sid, None)
 
+    def forget(self, soldier):
+        """Drop everything remembered by or about a soldier, so nobody keeps chasing it once it is recycled"""
+        targets = self._bb[Blackboard.TARGET]
+        targets.pop(soldier.my_id, None)
+        for sid in list(targets.pursuers(soldier)):
+            del targets[sid]
+        self._bb[Blackboard.WAYPOINT].pop(soldier.my_id, None)
+
 
 class TreeLoader:
-    """Loads Behaviors from disk"""
+    """Loads Behaviors from disk.
+    Each tree is parsed once and its nodes are shared by every soldier that runs it.
+    """
+    # tree name -> (mtimes of the files the tree was built from, root node)
+    _cache = {}
+    # tree name -> (mtimes of the files the tree was built from, compiled function)
+    _compiled = {}
+
     @staticmethod
     def file_path_from_name(tree_name):
         return os.path.normpath(f"./behaviors/{tree_name}.json")
@@ -53,22 +117,47 @@ class TreeLoader:
             raise InvalidBehaviorTree(f"No behavior named '{node_type_name}'' found")
 
     @staticmethod
-    def load_from_file(tree_name):
-        """Load a Behavior tree from disk.
+    def clear_cache():
+        TreeLoader._cache.clear()
+        TreeLoader._compiled.clear()
+
+    @staticmethod
+    def _is_current(file_mtimes):
+        """Returns True iff none of the files have changed since they were loaded"""
+        try:
+            return all(os.path.getmtime(path) == mtime for path, mtime in file_mtimes.items())
+        except OSError:
+            return False
+
+    @staticmethod
+    def load_from_file(tree_name, file_mtimes=None):
+        """Load a Behavior tree from disk, or reuse it if it was already loaded.
+        The mtimes of all files the tree is built from are added to file_mtimes.
         """
         #TODO detect cycles
-        file_path = TreeLoader.file_path_from_name(tree_name)
-        try:
-            with open(file_path) as def_file:
-                bt_json = json.load(def_file)
-            return TreeLoader.load_from_json(bt_json)
-        except FileNotFoundError:
-            raise InvalidBehaviorTree(f"Behavior tree definition file not found: {file_path}")
-        except json.JSONDecodeError as ex:
-            raise InvalidBehaviorTree(f"Behavior tree definition '{file_path}' could not be parsed: {ex}")
+        cached = TreeLoader._cache.get(tree_name, None)
+        if cached is None or not TreeLoader._is_current(cached[0]):
+            file_path = TreeLoader.file_path_from_name(tree_name)
+            try:
+                tree_mtimes = {file_path: os.path.getmtime(file_path)}
+                with open(file_path) as def_file:
+                    bt_json = json.load(def_file)
+                root = TreeLoader.load_from_json(bt_json, tree_mtimes)
+            except FileNotFoundError:
+                raise InvalidBehaviorTree(f"Behavior tree definition file not found: {file_path}")
+            except json.JSONDecodeError as ex:
+                raise InvalidBehaviorTree(f"Behavior tree definition '{file_path}' could not be parsed: {ex}")
+            if root is not None:
+                # Lets instrumentation name the sub-tree after its file
+                root.tree_name = tree_name
+            cached = (tree_mtimes, root)
+            TreeLoader._cache[tree_name] = cached
+        if file_mtimes is not None:
+            file_mtimes.update(cached[0])
+        return cached[1]
 
     @staticmethod
-    def load_from_json(bt_json):
+    def load_from_json(bt_json, file_mtimes=None):
         """Load a Behavior tree from the given JSON.
         Follows references to files and loads them as well.
         """
@@ -77,7 +166,7 @@ class TreeLoader:
             ntype = bt_json[0]
             node = TreeLoader.node_from_string(ntype)
             for child_json in bt_json[1:]:
-                child = TreeLoader.load_from_json(child_json)
+                child = TreeLoader.load_from_json(child_json, file_mtimes)
                 node.add_child(child)
             return node
         if isinstance(bt_json, str):
@@ -89,13 +178,315 @@ class TreeLoader:
                 pass
                 # This could be a sub-tree defined in a file
             # Look for a tree definition json file with this name
-            return TreeLoader.load_from_file(bt_json)
+            return TreeLoader.load_from_file(bt_json, file_mtimes)
         # Should not reach here
         raise InvalidBehaviorTree(f"Malformed behavior tree: {bt_json}")
 
+    @staticmethod
+    def compile_tree(tree_name):
+        """Load a Behavior tree and compile it into a single run(soldier, delta) function.
+        Compiled functions are cached and rebuilt when the tree is reloaded.
+        """
+        file_mtimes = {}
+        root = TreeLoader.load_from_file(tree_name, file_mtimes)
+        cached = TreeLoader._compiled.get(tree_name, None)
+        if cached is None or cached[0] != file_mtimes:
+            cached = (file_mtimes, TreeCompiler(tree_name).compile(root))
+            TreeLoader._compiled[tree_name] = cached
+        return cached[1]
+
+
+class TreeCompiler:
+    """Turns a tree of Behaviors into the source of one flat Python function.
+    Composites become nested ifs on a single result variable, so no node is dispatched
+    at runtime. The soldier's target and waypoint are looked up once at the top and only
+    refreshed after a node that changes them.
+    """
+    PROLOGUE = [
+        "def run(soldier, delta):",
+        "    sid = soldier.my_id",
+        "    targets = board[Blackboard.TARGET]",
+        "    waypoints = board[Blackboard.WAYPOINT]",
+        "    target = targets.get(sid, None)",
+        "    has_target = target is not None and target.is_alive()",
+        "    target_pos = target.pos if has_target else None",
+        "    waypoint = waypoints.get(sid, None)",
+    ]
+    REFRESH = {
+        Blackboard.TARGET: [
+            "if ok:",
+            "    target = targets.get(sid, None)",
+            "    has_target = target is not None and target.is_alive()",
+            "    target_pos = target.pos if has_target else None",
+        ],
+        Blackboard.WAYPOINT: [
+            "if ok:",
+            "    waypoint = waypoints.get(sid, None)",
+        ],
+    }
+
+    def __init__(self, tree_name):
+        self.tree_name = tree_name
+        self._bound = 0
+        self.namespace = {
+            "board": BehaviorTree.board(),
+            "Blackboard": Blackboard,
+            "arrive": BehaviorTree.arrive,
+            "aim": BehaviorTree.aim,
+            "AIM_STOP_RADIUS": BehaviorTree.AIM_STOP_RADIUS,
+        }
+
+    def bind(self, node):
+        """Make the node reachable from the generated code and return its name there"""
+        self._bound += 1
+        name = f"node_{self._bound}"
+        self.namespace[name] = node
+        return name
+
+    @staticmethod
+    def indent(lines):
+        return ["    " + line for line in lines]
+
+    def source(self, root):
+        if root is None:
+            body = ["ok = True"]
+        else:
+            body = root.compile(self)
+        return "\n".join(self.PROLOGUE + self.indent(body + ["return ok"])) + "\n"
+
+    def compile(self, root):
+        source = self.source(root)
+        code = compile(source, f"<behavior tree {self.tree_name}>", "exec")
+        # Running the generated source is the whole point, it is built only from the tree's own nodes
+        exec(code, self.namespace)  # pylint: disable=exec-used
+        run = self.namespace["run"]
+        # Keep the generated code around for debugging
+        run.source = source
+        return run
+
+
+class NodeStats:
+    """Counters for one node of an instrumented tree"""
+    def __init__(self, path, node_type, children=()):
+        self.path = path
+        self.node_type = node_type
+        self.children = children
+        self.calls = 0
+        self.successes = 0
+        self.seconds = 0.0
+
+    def self_seconds(self):
+        """Time spent in this node, not counting its children"""
+        return self.seconds - sum(child.seconds for child in self.children)
+
+    def as_dict(self):
+        return {
+            "path": self.path,
+            "type": self.node_type,
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.calls - self.successes,
+            "success_ratio": self.successes / self.calls if self.calls else None,
+            "total_ms": self.seconds * 1000,
+            "self_ms": self.self_seconds() * 1000,
+        }
+
+
+class InstrumentedNode:
+    """Stands in for a node of one tree and records every time it is run.
+    Only built while instrumentation is enabled, normal trees never go through it.
+    """
+    def __init__(self, node, stats):
+        self.node = node
+        self.stats = stats
+
+    def run(self, soldier, delta):
+        start = time.perf_counter()
+        result = self.node.run(soldier, delta)
+        self.stats.seconds += time.perf_counter() - start
+        self.stats.calls += 1
+        if result:
+            self.stats.successes += 1
+        return result
+
+    def run_batch(self, batch, mask):
+        start = time.perf_counter()
+        result = self.node.run_batch(batch, mask)
+        self.stats.seconds += time.perf_counter() - start
+        # Count every soldier the node was run for, so the numbers match the other engines
+        self.stats.calls += int(numpy.count_nonzero(mask))
+        self.stats.successes += int(numpy.count_nonzero(result))
+        return result
+
+
+class TreeInstrumentation:
+    """Optional per-node statistics for behavior trees.
+    While enabled, newly created BehaviorTrees run an instrumented copy of their tree
+    with the interpreted engine, since compiled trees have no nodes left to time.
+    Nodes are named by their path from the tree file, sub-trees by their file name,
+    e.g. archer/Selector[1]/ranged_attack_sequence/TargetEnemy.
+    """
+    enabled = False
+    # tree name -> (original root, instrumented root)
+    _roots = {}
+    # tree name -> {path: NodeStats}, in tree order
+    _stats = {}
+
+    @staticmethod
+    def enable():
+        TreeInstrumentation.enabled = True
+
+    @staticmethod
+    def disable():
+        """Stop instrumenting new trees, statistics gathered so far are kept"""
+        TreeInstrumentation.enabled = False
+
+    @staticmethod
+    def reset():
+        TreeInstrumentation._roots.clear()
+        TreeInstrumentation._stats.clear()
+
+    @staticmethod
+    def root_for(tree_name, root):
+        """Get the instrumented copy of a tree, it is rebuilt if the tree was reloaded"""
+        if root is None:
+            return None
+        cached = TreeInstrumentation._roots.get(tree_name, None)
+        if cached is None or cached[0] is not root:
+            stats = {}
+            cached = (root, TreeInstrumentation._instrument(root, tree_name, stats))
+            TreeInstrumentation._roots[tree_name] = cached
+            TreeInstrumentation._stats[tree_name] = stats
+        return cached[1]
+
+    @staticmethod
+    def _segment(child, index, siblings):
+        """Name of a child in its parent's path"""
+        if child.tree_name is not None:
+            return child.tree_name
+        name = child.__class__.__name__
+        if isinstance(child, BehaviorTree.CompositeNode) or \
+                sum(isinstance(sibling, child.__class__) for sibling in siblings) > 1:
+            name += f"[{index}]"
+        return name
+
+    @staticmethod
+    def _instrument(node, path, stats):
+        """Copy the tree below node with every node wrapped in an InstrumentedNode"""
+        node_stats = NodeStats(path, node.__class__.__name__)
+        stats[path] = node_stats
+        if isinstance(node, BehaviorTree.CompositeNode):
+            # Nodes are shared between trees, so composites are copied rather than changed
+            original = node
+            node = node.__class__()
+            for index, child in enumerate(original.children):
+                child_path = f"{path}/{TreeInstrumentation._segment(child, index, original.children)}"
+                node.children += (TreeInstrumentation._instrument(child, child_path, stats),)
+            node_stats.children = tuple(child.stats for child in node.children)
+        return InstrumentedNode(node, node_stats)
+
+    @staticmethod
+    def report():
+        """Statistics of every instrumented node.
+        Returns {"trees": {tree name: [node stats in tree order]},
+                 "node_types": {node type: totals over all trees, slowest first}}
+        """
+        trees = {}
+        node_types = {}
+        for tree_name, stats in TreeInstrumentation._stats.items():
+            trees[tree_name] = [node_stats.as_dict() for node_stats in stats.values()]
+            for node_stats in stats.values():
+                totals = node_types.setdefault(node_stats.node_type,
+                                               {"calls": 0, "successes": 0, "self_ms": 0.0})
+                totals["calls"] += node_stats.calls
+                totals["successes"] += node_stats.successes
+                totals["self_ms"] += node_stats.self_seconds() * 1000
+        node_types = dict(sorted(node_types.items(), key=lambda item: -item[1]["self_ms"]))
+        return {"trees": trees, "node_types": node_types}
+
+    @staticmethod
+    def dump(out=sys.stdout):
+        """Write the report as a readable table"""
+        report = TreeInstrumentation.report()
+        header = f"{'calls':>10} {'success':>8} {'total ms':>10} {'self ms':>10}  "
+        for tree_name, rows in report["trees"].items():
+            print(f"{header}{tree_name}", file=out)
+            for row in rows:
+                ratio = "" if row["success_ratio"] is None else f"{row['success_ratio']:.1%}"
+                print(f"{row['calls']:>10} {ratio:>8} {row['total_ms']:>10.2f} {row['self_ms']:>10.2f}  "
+                      f"{row['path']}", file=out)
+            print(file=out)
+        print(f"{header}node type", file=out)
+        for node_type, totals in report["node_types"].items():
+            ratio = f"{totals['successes'] / totals['calls']:.1%}" if totals["calls"] else ""
+            print(f"{totals['calls']:>10} {ratio:>8} {'':>10} {totals['self_ms']:>10.2f}  {node_type}", file=out)
+
+
+class BatchContext:
+    """State shared by every node while one tree is run for a group of soldiers at once.
+    Nodes take a boolean mask of the soldiers still running them and return a mask of
+    the ones that succeeded.
+    """
+    def __init__(self, soldiers, delta):
+        board = BehaviorTree.board()
+        self.soldiers = soldiers
+        self.delta = delta
+        self.store = soldiers[0].store()
+        self.slots = numpy.fromiter((soldier.slot for soldier in soldiers), dtype=numpy.intp,
+                                    count=len(soldiers))
+        self.index = board[Blackboard.SOLDIER_INDEX]
+        self.index_rows = self.index.rows_for(soldiers)
+        rows = numpy.arange(len(soldiers))
+        self.target_slots = numpy.full(len(soldiers), -1, dtype=numpy.intp)
+        self.waypoints = numpy.zeros((len(soldiers), 2))
+        self.has_waypoint = numpy.zeros(len(soldiers), dtype=bool)
+        self.refresh(Blackboard.TARGET, rows)
+        self.refresh(Blackboard.WAYPOINT, rows)
+        self._attack_ranges = None
+        self._flee_ranges = None
+
+    def refresh(self, key, rows):
+        """Re-read the blackboard entries of the given rows"""
+        if key == Blackboard.TARGET:
+            targets = BehaviorTree.board()[Blackboard.TARGET]
+            for row in rows:
+                target = targets.get(self.soldiers[row].my_id, None)
+                self.target_slots[row] = target.slot if target and target.is_alive() else -1
+        elif key == Blackboard.WAYPOINT:
+            waypoints = BehaviorTree.board()[Blackboard.WAYPOINT]
+            for row in rows:
+                waypoint = waypoints.get(self.soldiers[row].my_id, None)
+                self.has_waypoint[row] = bool(waypoint)
+                if waypoint:
+                    self.waypoints[row] = waypoint
+
+    def has_target(self, mask):
+        return mask & (self.target_slots >= 0)
+
+    def target_positions(self, rows):
+        return self.store.pos[self.target_slots[rows]]
+
+    def target_distances(self, rows):
+        offset = self.target_positions(rows) - self.store.pos[self.slots[rows]]
+        return numpy.hypot(offset[:, 0], offset[:, 1])
+
+    def attack_ranges(self):
+        if self._attack_ranges is None:
+            self._attack_ranges = numpy.array([soldier.get_attack_range() for soldier in self.soldiers],
+                                              dtype=float)
+        return self._attack_ranges
+
+    def flee_ranges(self):
+        if self._flee_ranges is None:
+            self._flee_ranges = numpy.array([soldier.get_flee_range() for soldier in self.soldiers],
+                                            dtype=float)
+        return self._flee_ranges
+
 
 class BehaviorTree:
-    """Holds a tree made up of Behaviors"""
+    """Holds a tree made up of Behaviors.
+    Nodes keep no per-soldier state, anything that must be remembered goes on the blackboard.
+    """
     ARRIVE_SLOW_RADIUS = 100
     ARRIVE_STOP_RADIUS = 25
     AIM_SLOW_RADIUS = 40.0
@@ -108,14 +499,56 @@ class BehaviorTree:
         """Gets the blackboard for this tree"""
         return BehaviorTree._blackboard
 
-    def __init__(self, file_path):
-        self.root = TreeLoader.load_from_file(file_path)
+    INTERPRETED = "interpreted"
+    COMPILED = "compiled"
+    # Walks each tree once per frame for all the soldiers sharing it, see run_batched
+    BATCHED = "batched"
+    ENGINES = (INTERPRETED, COMPILED, BATCHED)
+    # Which engine newly created trees run with
+    ENGINE = COMPILED
+
+    # Every soldier has one, keep them small
+    __slots__ = ("tree_name", "root", "_compiled", "_setup")
+
+    def __init__(self, tree_name):
+        self.tree_name = tree_name
+        # The root is shared with every other BehaviorTree of this name
+        self.root = TreeLoader.load_from_file(tree_name)
+        self._compiled = None
+        self._setup = BehaviorTree._current_setup()
+        if TreeInstrumentation.enabled:
+            self.root = TreeInstrumentation.root_for(tree_name, self.root)
+        elif BehaviorTree.ENGINE == BehaviorTree.COMPILED:
+            self._compiled = TreeLoader.compile_tree(tree_name)
+
+    @staticmethod
+    def _current_setup():
+        return BehaviorTree.ENGINE, TreeInstrumentation.enabled
+
+    def is_current(self):
+        """Whether the tree was made for the engine and instrumentation in use now"""
+        return self._setup == BehaviorTree._current_setup()
 
     def run(self, soldier, delta):
+        if self._compiled is not None:
+            return self._compiled(soldier, delta)
         if self.root is None:
             return True
         return self.root.run(soldier, delta)
 
+    @staticmethod
+    def run_batched(soldiers, delta):
+        """Run the behaviors of all the given living soldiers.
+        Soldiers sharing a tree are run together with one walk of that tree.
+        """
+        groups = {}
+        for soldier in soldiers:
+            groups.setdefault(soldier.behavior_tree.root, []).append(soldier)
+        for root, group in groups.items():
+            if root is None:
+                continue
+            root.run_batch(BatchContext(group, delta), numpy.ones(len(group), dtype=bool))
+
     @staticmethod
     def arrive(movable, destination, flee=False,
                slow_radius=ARRIVE_SLOW_RADIUS, stop_radius=ARRIVE_STOP_RADIUS):
@@ -153,24 +586,83 @@ class BehaviorTree:
         movable.add_rotation_steering(goal_rot - movable.rotation)
         return True
 
+    @staticmethod
+    def arrive_batch(store, slots, destinations, flee=False,
+                     slow_radius=ARRIVE_SLOW_RADIUS, stop_radius=ARRIVE_STOP_RADIUS):
+        """Vectorized arrive for every slot in the store"""
+        if flee:
+            direction = store.pos[slots] - destinations
+        else:
+            direction = destinations - store.pos[slots]
+        dist = numpy.hypot(direction[:, 0], direction[:, 1])
+        max_velocity = store.max_velocity[slots]
+        goal_speed = numpy.where(dist > slow_radius, max_velocity, max_velocity * dist / slow_radius)
+        goal_speed[dist < stop_radius] = 0
+        # Stopped soldiers have a goal speed of 0, so the divisor is never used for them
+        goal_velocity = direction * (goal_speed / numpy.where(dist > 0, dist, 1))[:, numpy.newaxis]
+        store.add_velocity_steering(slots, goal_velocity - store.velocity[slots])
+
+    @staticmethod
+    def aim_batch(store, slots, destinations, slow_radius=AIM_SLOW_RADIUS, stop_radius=AIM_STOP_RADIUS):
+        """Vectorized aim for every slot in the store"""
+        rotation = store.rotation_to_dest(slots, destinations)
+        rot_size = numpy.abs(rotation)
+        max_rotation = store.max_rotation[slots]
+        goal_rot = numpy.where(rot_size > slow_radius, max_rotation, max_rotation * rot_size / slow_radius)
+        goal_rot = numpy.where(rot_size < stop_radius, 0, goal_rot * numpy.sign(rotation))
+        store.add_rotation_steering(slots, goal_rot - store.rotation[slots])
+
     class LeafNode:
         """Parent class for non-composite behaviors"""
+        # Expression the compiler can inline instead of calling run
+        INLINE = None
+        # Blackboard entry that run may change for the soldier
+        WRITES = None
+        # Name of the file this node is the root of, if any
+        tree_name = None
+
         def run(self, soldier, delta):
             raise NotImplementedError()
 
         def add_child(self, child):
             raise InvalidBehaviorTree(f"{self.__class__} does not support adding children")
 
+        def run_batch(self, batch, mask):
+            """Fallback for leaves without a vectorized version, runs each soldier in turn"""
+            result = numpy.zeros_like(mask)
+            rows = numpy.flatnonzero(mask)
+            for row in rows:
+                result[row] = self.run(batch.soldiers[row], batch.delta)
+            if self.WRITES is not None:
+                batch.refresh(self.WRITES, rows)
+            return result
+
+        def compile(self, compiler):
+            if self.INLINE is not None:
+                lines = [f"ok = {self.INLINE}"]
+            else:
+                lines = [f"ok = {compiler.bind(self)}.run(soldier, delta)"]
+            return lines + TreeCompiler.REFRESH.get(self.WRITES, [])
+
     class CompositeNode:
         """Parent class for behaviors that hold other behaviors"""
+        # Name of the file this node is the root of, if any
+        tree_name = None
+
         def __init__(self):
-            self.children = []
+            self.children = ()
 
         def run(self, soldier, delta):
             raise NotImplementedError()
 
         def add_child(self, child):
-            self.children.append(child)
+            self.children += (child,)
+
+        def run_batch(self, batch, mask):
+            raise NotImplementedError()
+
+        def compile(self, compiler):
+            raise NotImplementedError()
 
     class Selector(CompositeNode):
         def run(self, soldier, delta):
@@ -180,6 +672,28 @@ class BehaviorTree:
                     return True
             return False
 
+        def run_batch(self, batch, mask):
+            # Soldiers that fail one child move on to the next
+            succeeded = numpy.zeros_like(mask)
+            remaining = mask
+            for node in self.children:
+                if not remaining.any():
+                    break
+                result = node.run_batch(batch, remaining)
+                succeeded |= result
+                remaining = remaining & ~result
+            return succeeded
+
+        def compile(self, compiler):
+            if not self.children:
+                return ["ok = False"]
+            compiled = [child.compile(compiler) for child in self.children]
+            lines = compiled.pop()
+            for child_lines in reversed(compiled):
+                # Only try the next child when this one failed
+                lines = child_lines + ["if not ok:"] + compiler.indent(lines)
+            return lines
+
     class Sequence(CompositeNode):
         def run(self, soldier, delta):
             for node in self.children:
@@ -188,10 +702,34 @@ class BehaviorTree:
                     return False
             return True
 
+        def run_batch(self, batch, mask):
+            # Only soldiers that succeed one child move on to the next
+            for node in self.children:
+                if not mask.any():
+                    break
+                mask = node.run_batch(batch, mask)
+            return mask
+
+        def compile(self, compiler):
+            if not self.children:
+                return ["ok = True"]
+            compiled = [child.compile(compiler) for child in self.children]
+            lines = compiled.pop()
+            for child_lines in reversed(compiled):
+                # Only run the next child when this one succeeded
+                lines = child_lines + ["if ok:"] + compiler.indent(lines)
+            return lines
+
     class Invert(CompositeNode):
         def run(self, soldier, delta):
             return not self.children[0].run(soldier, delta)
 
+        def run_batch(self, batch, mask):
+            return mask & ~self.children[0].run_batch(batch, mask)
+
+        def compile(self, compiler):
+            return self.children[0].compile(compiler) + ["ok = not ok"]
+
         def add_child(self, child):
             if self.children:
                 raise InvalidBehaviorTree("Invert supports at most 1 child")
@@ -202,21 +740,37 @@ class BehaviorTree:
             self.children[0].run(soldier, delta)
             return True
 
+        def run_batch(self, batch, mask):
+            self.children[0].run_batch(batch, mask)
+            return mask.copy()
+
+        def compile(self, compiler):
+            return self.children[0].compile(compiler) + ["ok = True"]
+
         def add_child(self, child):
             if self.children:
                 raise InvalidBehaviorTree("AlwaysTrue supports at most 1 child")
             BehaviorTree.CompositeNode.add_child(self, child)
 
     class ArriveTarget(LeafNode):
+        INLINE = "has_target and arrive(soldier, target_pos)"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if not target or not target.is_alive():
                 return False
             return BehaviorTree.arrive(soldier, target.pos)
 
+        def run_batch(self, batch, mask):
+            result = batch.has_target(mask)
+            rows = numpy.flatnonzero(result)
+            BehaviorTree.arrive_batch(batch.store, batch.slots[rows], batch.target_positions(rows))
+            return result
+
     class ArriveWaypoint(LeafNode):
         SLOW_RAD = 30
         STOP_RAD = 2
+        INLINE = f"bool(waypoint) and arrive(soldier, waypoint, slow_radius={SLOW_RAD}, stop_radius={STOP_RAD})"
 
         def run(self, soldier, delta):
             waypoint = BehaviorTree.board().get_for_id(Blackboard.WAYPOINT, soldier.my_id)
@@ -225,79 +779,128 @@ class BehaviorTree:
             return BehaviorTree.arrive(soldier, waypoint, slow_radius=self.SLOW_RAD,
                                        stop_radius=self.STOP_RAD)
 
+        def run_batch(self, batch, mask):
+            result = mask & batch.has_waypoint
+            rows = numpy.flatnonzero(result)
+            BehaviorTree.arrive_batch(batch.store, batch.slots[rows], batch.waypoints[rows],
+                                      slow_radius=self.SLOW_RAD, stop_radius=self.STOP_RAD)
+            return result
+
     class AimTarget(LeafNode):
+        INLINE = "has_target and aim(soldier, target_pos)"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if not target or not target.is_alive():
                 return False
             return BehaviorTree.aim(soldier, target.pos)
 
+        def run_batch(self, batch, mask):
+            result = batch.has_target(mask)
+            rows = numpy.flatnonzero(result)
+            BehaviorTree.aim_batch(batch.store, batch.slots[rows], batch.target_positions(rows))
+            return result
+
     class AimWaypoint(LeafNode):
+        INLINE = "bool(waypoint) and aim(soldier, waypoint)"
+
         def run(self, soldier, delta):
             waypoint = BehaviorTree.board().get_for_id(Blackboard.WAYPOINT, soldier.my_id)
             if not waypoint:
                 return False
             return BehaviorTree.aim(soldier, waypoint)
 
+        def run_batch(self, batch, mask):
+            result = mask & batch.has_waypoint
+            rows = numpy.flatnonzero(result)
+            BehaviorTree.aim_batch(batch.store, batch.slots[rows], batch.waypoints[rows])
+            return result
+
     class FleeTarget(LeafNode):
+        INLINE = "has_target and arrive(soldier, target_pos, flee=True)"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if not target or not target.is_alive():
                 return False
             return BehaviorTree.arrive(soldier, target.pos, flee=True)
 
+        def run_batch(self, batch, mask):
+            result = batch.has_target(mask)
+            rows = numpy.flatnonzero(result)
+            BehaviorTree.arrive_batch(batch.store, batch.slots[rows], batch.target_positions(rows), flee=True)
+            return result
+
     class SpreadOut(LeafNode):
         SPREAD_DIST = 20
 
         def run(self, soldier, delta):
-            soldiers = BehaviorTree.board()[Blackboard.SOLDIERS]
-            for other in soldiers.values():
-                if soldier.my_id == other.my_id or not other.is_alive():
-                    continue
-                displacement = soldier.pos - other.pos
-                if displacement.length() < self.SPREAD_DIST:
-                    displacement.normalize()
-                    steering = displacement * soldier.max_velocity
-                    soldier.add_velocity_steering(steering)
+            # Separation for every soldier is found together with one neighbor query
+            index = BehaviorTree.board()[Blackboard.SOLDIER_INDEX]
+            soldier.velocity_steering += index.separation(soldier, self.SPREAD_DIST)
             return True
 
+        def run_batch(self, batch, mask):
+            rows = numpy.flatnonzero(mask)
+            separations = batch.index.separations(self.SPREAD_DIST)
+            batch.store.velocity_steering[batch.slots[rows]] += separations[batch.index_rows[rows]]
+            return mask.copy()
+
     class HasTarget(LeafNode):
+        INLINE = "has_target"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if target is None or not target.is_alive():
                 return False
             return True
 
+        def run_batch(self, batch, mask):
+            return batch.has_target(mask)
+
     class TargetEnemy(LeafNode):
+        WRITES = Blackboard.TARGET
+
         def run(self, soldier, delta):
-            soldiers = BehaviorTree.board()[Blackboard.SOLDIERS]
-            closest_enemy = None
-            closest_dist = float("inf")
-            for enemy in soldiers.values():
-                if enemy.army == soldier.army:
-                    # Same team
-                    continue
-                if not enemy.is_alive():
-                    continue
-                dist = soldier.pos.distance_to(enemy.pos)
-                if dist <= soldier.sight_range and dist <= closest_dist:
-                    # This is the closest so far
-                    closest_enemy = enemy
-                    closest_dist = dist
+            # Closest enemies for every soldier are found together in one batched query
+            closest_enemy = BehaviorTree.board()[Blackboard.SOLDIER_INDEX].nearest_enemy(soldier)
             if not closest_enemy:
                 # No enemies in range
                 return False
             BehaviorTree.board()[Blackboard.TARGET][soldier.my_id] = closest_enemy
             return True
 
+        def run_batch(self, batch, mask):
+            rows = numpy.flatnonzero(mask)
+            enemies = batch.index.nearest_enemy_rows()[batch.index_rows[rows]]
+            found = enemies >= 0
+            rows, enemies = rows[found], enemies[found]
+            targets = BehaviorTree.board()[Blackboard.TARGET]
+            for row, enemy in zip(rows, enemies):
+                targets[batch.soldiers[row].my_id] = batch.index.soldiers[enemy]
+            batch.target_slots[rows] = batch.index.slots[enemies]
+            result = numpy.zeros_like(mask)
+            result[rows] = True
+            return result
+
     class TargetInAttackRange(LeafNode):
+        INLINE = "has_target and soldier.pos.distance_to(target_pos) <= soldier.get_attack_range()"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if not target or not target.is_alive():
                 return False
             return soldier.pos.distance_to(target.pos) <= soldier.get_attack_range()
 
+        def run_batch(self, batch, mask):
+            result = batch.has_target(mask)
+            rows = numpy.flatnonzero(result)
+            result[rows] = batch.target_distances(rows) <= batch.attack_ranges()[rows]
+            return result
+
     class FacingTarget(LeafNode):
+        INLINE = "has_target and abs(soldier.get_rotation_to_dest(target_pos)) <= AIM_STOP_RADIUS"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if not target or not target.is_alive():
@@ -306,19 +909,96 @@ class BehaviorTree:
             rot_size = abs(rotation)
             return rot_size <= BehaviorTree.AIM_STOP_RADIUS
 
+        def run_batch(self, batch, mask):
+            result = batch.has_target(mask)
+            rows = numpy.flatnonzero(result)
+            rotation = batch.store.rotation_to_dest(batch.slots[rows], batch.target_positions(rows))
+            result[rows] = numpy.abs(rotation) <= BehaviorTree.AIM_STOP_RADIUS
+            return result
+
     class TargetInFleeRange(LeafNode):
+        INLINE = "has_target and soldier.pos.distance_to(target_pos) <= soldier.get_flee_range()"
+
         def run(self, soldier, delta):
             target = BehaviorTree.board().get_for_id(Blackboard.TARGET, soldier.my_id)
             if not target or not target.is_alive():
                 return False
             return soldier.pos.distance_to(target.pos) <= soldier.get_flee_range()
 
+        def run_batch(self, batch, mask):
+            result = batch.has_target(mask)
+            rows = numpy.flatnonzero(result)
+            result[rows] = batch.target_distances(rows) <= batch.flee_ranges()[rows]
+            return result
+
     class Attack(LeafNode):
         def run(self, soldier, delta):
             soldier.attack()
             return True
 
+    class InfluenceLeaf(LeafNode):
+        """Parent class for leaves that steer along the slope of the soldier's army's influence map.
+        Only a few cells of the map are read per soldier, no other soldiers are looked at.
+        """
+        # How far ahead along the slope to steer towards
+        LOOKAHEAD = 50
+        # 1 to head towards more friendly influence, -1 towards less
+        DIRECTION = 1
+
+        def applies(self, influence):
+            """Which soldiers, given the influence where they stand, should move"""
+            raise NotImplementedError()
+
+        def destinations(self, influence_map, positions, army_ids):
+            """Returns a mask of the positions the leaf applies to and where those should head"""
+            influence = influence_map.sample(positions, army_ids)
+            gradient = influence_map.sample_gradient(positions, army_ids)
+            length = numpy.hypot(gradient[:, 0], gradient[:, 1])
+            applies = self.applies(influence) & (length > 0)
+            step = gradient[applies] * (self.DIRECTION * self.LOOKAHEAD / length[applies])[:, numpy.newaxis]
+            return applies, positions[applies] + step
+
+        def run(self, soldier, delta):
+            influence_map = BehaviorTree.board()[Blackboard.INFLUENCE]
+            if influence_map is None or not soldier.army:
+                return False
+            applies, destinations = self.destinations(influence_map, numpy.array([tuple(soldier.pos)]),
+                                                      soldier.army.my_id)
+            if not applies[0]:
+                return False
+            return BehaviorTree.arrive(soldier, Vector2(*destinations[0].tolist()))
+
+        def run_batch(self, batch, mask):
+            result = numpy.zeros_like(mask)
+            influence_map = BehaviorTree.board()[Blackboard.INFLUENCE]
+            if influence_map is None:
+                return result
+            rows = numpy.flatnonzero(mask)
+            army_ids = [batch.soldiers[row].army.my_id if batch.soldiers[row].army else None for row in rows]
+            applies, destinations = self.destinations(influence_map, batch.store.pos[batch.slots[rows]], army_ids)
+            rows = rows[applies]
+            BehaviorTree.arrive_batch(batch.store, batch.slots[rows], destinations)
+            result[rows] = True
+            return result
+
+    class RetreatToSafety(InfluenceLeaf):
+        """Falls back towards friendly ground while the enemy dominates where the soldier stands"""
+        THRESHOLD = -0.002
+
+        def applies(self, influence):
+            return influence < self.THRESHOLD
+
+    class AdvanceOnWeakness(InfluenceLeaf):
+        """Pushes out towards contested ground while the army dominates where the soldier stands"""
+        THRESHOLD = 0.002
+        DIRECTION = -1
+
+        def applies(self, influence):
+            return influence > self.THRESHOLD
+
     class TakeFormationWaypoint(LeafNode):
+        WRITES = Blackboard.WAYPOINT
+
         def run(self, soldier, delta):
             if not soldier.formation:
                 return False
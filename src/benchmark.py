@@ -0,0 +1,366 @@
+"""
+Benchmarks measuring how the simulation scales with the number of soldiers.
+Results are printed as JSON so they can be compared between releases.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import functools
+import tracemalloc
+import argparse
+import platform
+import numpy
+
+# pygame greets on import, keep that out of the JSON written to stdout
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+# pylint: disable=wrong-import-position
+import pygame
+from src.battles import Battles
+from src.behavior import BehaviorTree
+from src.formation import FormationLoader, Slot
+from src.influence import InfluenceMap
+from src.soldier import Soldier, Swordsperson, Archer
+from src.weapon import Arrow
+from src.projectile import ProjectilePool
+from src.pool import ObjectPool
+# pylint: enable=wrong-import-position
+
+
+SOLDIER_COUNTS = (100, 500, 2000, 10000)
+FORMATIONS = ("1_box", "2_front", "3_spear", "4_x")
+DEFAULT_TICKS = 60
+DEFAULT_DELTA = 1 / 60
+PHASES = ("update", "handle_interactions", "clean_up", "influence_update", "draw")
+
+# Space left between neighboring formations
+FORMATION_GAP = 20
+
+# Influence grid cell sizes in pixels, the game uses the first
+INFLUENCE_RESOLUTIONS = (25, 10, 5)
+DIFFUSION_SOLDIERS = 2000
+DIFFUSION_WARMUP_TICKS = 120
+DIFFUSION_REPEATS = 20
+
+# Instances to measure the memory of
+MEMORY_COUNTS = (10000, 100000)
+
+# Sustained archery battle used to count allocations, long enough for the dead to be cleaned up and replaced
+ALLOCATION_SOLDIERS = 500
+ALLOCATION_TICKS = 3600
+ALLOCATION_WINDOW = 600
+REINFORCE_INTERVAL = 60
+
+
+def soldier_class_for(slot, melee_class):
+    return Archer if slot.type == Slot.RANGED else melee_class
+
+
+def build_scenario(battles, formation_name, soldier_count, melee_class=Swordsperson):
+    """Split soldier_count soldiers between two armies that charge at each other.
+    Each army is a grid of formations of the given type, filled slot by slot.
+    Ranged slots get archers, every other slot gets a melee_class, swordspeople by default.
+    """
+    template = FormationLoader.get_for_name(formation_name)
+    slots_per_formation = len(template.slots)
+    extent = max(max(abs(slot.formation_offset.x), abs(slot.formation_offset.y)) for slot in template.slots)
+    spacing = extent * 2 + FORMATION_GAP
+    field_width, field_height = Battles.SCREEN_SIZE
+
+    for army_num in range(2):
+        army_soldiers = soldier_count // 2 + (soldier_count % 2 if army_num == 0 else 0)
+        num_formations = -(-army_soldiers // slots_per_formation)
+        # Lay the formations out in a roughly square grid, growing away from the center
+        columns = max(int(numpy.sqrt(num_formations)), 1)
+        direction = -1 if army_num == 0 else 1
+        army_x = field_width / 2 + direction * field_width / 4
+        army = battles.create_army((army_x, field_height / 2))
+
+        for form_num in range(num_formations):
+            row, col = divmod(form_num, columns)
+            x_pos = army_x + direction * col * spacing
+            y_pos = field_height / 2 + (row - num_formations / columns / 2) * spacing
+            formation = FormationLoader.get_for_name(formation_name)
+            army.add_formation(formation, x_pos, y_pos)
+            for slot in formation.slots:
+                if army_soldiers == 0:
+                    break
+                formation.add_soldier(battles.create_soldier(soldier_class_for(slot, melee_class)))
+                army_soldiers -= 1
+    battles.charge()
+
+
+def reinforce(battles, melee_class=Swordsperson):
+    """Fill every empty slot of every formation with a new soldier, the way build_scenario fills them"""
+    for army in battles.armies.values():
+        battles.active_army = army
+        for formation in army.formations:
+            for slot in formation.slots:
+                if slot.soldier is None:
+                    formation.add_soldier(battles.create_soldier(soldier_class_for(slot, melee_class)))
+
+
+def run_scenario(battles, ticks, delta, draw):
+    """Run ticks of the simulation, timing every phase separately.
+    Returns {phase: [seconds for each tick]}
+    """
+    timings = {phase: [] for phase in PHASES}
+    steps = [
+        ("update", lambda: battles.update(delta)),
+        ("handle_interactions", battles.handle_interactions),
+        ("clean_up", battles.clean_up),
+        ("influence_update", battles.influence_map.update),
+    ]
+    if draw:
+        steps.append(("draw", battles.draw))
+    for _ in range(ticks):
+        for phase, step in steps:
+            start = time.perf_counter()
+            step()
+            timings[phase].append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(samples):
+    """Milliseconds per tick statistics for a list of timings in seconds"""
+    if not samples:
+        return None
+    millis = numpy.array(samples) * 1000
+    return {
+        "mean": float(millis.mean()),
+        "p50": float(numpy.percentile(millis, 50)),
+        "p95": float(numpy.percentile(millis, 95)),
+        "max": float(millis.max()),
+    }
+
+
+def run_benchmarks(counts, formations, ticks, delta, draw):
+    results = []
+    battles = Battles(headless=not draw)
+    battles.setup(False)
+    for formation_name in formations:
+        for count in counts:
+            battles.blank_slate()
+            build_scenario(battles, formation_name, count)
+            timings = run_scenario(battles, ticks, delta, draw)
+            phases = {phase: summarize(samples) for phase, samples in timings.items()}
+            total = sum(numpy.array(samples) for samples in timings.values() if samples)
+            results.append({
+                "formation": formation_name,
+                "soldiers": count,
+                "ms_per_tick": phases,
+                "total_ms_per_tick": summarize(list(total)),
+            })
+            print(f"{formation_name} {count}: {phases['update']['mean']:.2f} ms update, "
+                  f"{results[-1]['total_ms_per_tick']['mean']:.2f} ms total", file=sys.stderr)
+    battles.blank_slate()
+    return results
+
+
+def run_diffusion_benchmarks(resolutions, repeats):
+    """Time every diffusion backend on the same splatted maps and compare them to the reference.
+    Errors are relative to the largest value in the reference maps.
+    """
+    battles = Battles(headless=True)
+    battles.setup(False)
+    build_scenario(battles, FORMATIONS[0], DIFFUSION_SOLDIERS)
+    battles.run_headless(DIFFUSION_WARMUP_TICKS, DEFAULT_DELTA)
+
+    results = []
+    for resolution in resolutions:
+        reference = None
+        for name in InfluenceMap.DIFFUSIONS:
+            influence_map = InfluenceMap(Battles.SCREEN_SIZE, battles.soldiers, battles.armies,
+                                         grid_resolution=resolution, diffusion=name)
+            influence_map.update()
+            maps, out = influence_map.layers.base_maps, influence_map.layers.diffused
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                influence_map.diffusion.apply(maps, out)
+                samples.append(time.perf_counter() - start)
+            if reference is None:
+                reference = out.copy()
+            scale = numpy.abs(reference).max() or 1.0
+            results.append({
+                "diffusion": name,
+                "grid": [influence_map.rows, influence_map.columns],
+                "ms_per_update": summarize(samples),
+                "max_error": float(numpy.abs(out - reference).max() / scale),
+                "mean_error": float(numpy.abs(out - reference).mean() / scale),
+                # Fraction of cells drawn in a different army's color
+                "owner_mismatch": float((out.argmax(axis=0) != reference.argmax(axis=0)).mean()),
+            })
+            print(f"{name} {influence_map.rows}x{influence_map.columns}: "
+                  f"{results[-1]['ms_per_update']['p50']:.3f} ms, max error {results[-1]['max_error']:.2e}",
+                  file=sys.stderr)
+    battles.blank_slate()
+    return results
+
+
+def store_bytes_per_row(store, fields):
+    """Bytes of one row across the given arrays of a struct of arrays store"""
+    return sum(getattr(store, name).nbytes for name in fields) / store.capacity
+
+
+def measure_allocation(build, count):
+    """Bytes allocated per instance while build() makes count instances, which it returns to keep alive"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    gc.collect()
+    return (after - before) / count
+
+
+def build_soldiers(soldier_class, count):
+    return [soldier_class() for _ in range(count)]
+
+
+def fire_arrows(pool, count):
+    for _ in range(count):
+        pool.fire((0, 0), 0, Arrow.FLIGHT_SPEED, Arrow.MAX_DISTANCE, 20)
+
+
+def run_memory_benchmarks(counts):
+    """Bytes per soldier and per arrow in flight.
+    Objects are measured with tracemalloc, including a reference to each in a list. Every store is grown
+    beforehand, so store rows are counted separately from its arrays instead of by when they happened to grow.
+    """
+    results = []
+    soldier_store = Soldier.store()
+    soldier_row = store_bytes_per_row(soldier_store, soldier_store.VECTOR_FIELDS + soldier_store.SCALAR_FIELDS)
+    for count in counts:
+        for soldier_class in (Swordsperson, Archer):
+            build = functools.partial(build_soldiers, soldier_class, count)
+            # Grow the store, the slots are freed again once the soldiers are gone
+            build()
+            object_bytes = measure_allocation(build, count)
+            results.append({"object": soldier_class.__name__, "count": count, "object_bytes": object_bytes,
+                            "store_bytes": soldier_row, "bytes_each": object_bytes + soldier_row})
+
+        pool = ProjectilePool()
+        fire = functools.partial(fire_arrows, pool, count)
+        fire()
+        pool.clear()
+        arrow_row = store_bytes_per_row(pool, pool.VECTOR_FIELDS + pool.SCALAR_FIELDS + ("owner", "alive"))
+        object_bytes = measure_allocation(fire, count)
+        results.append({"object": "Arrow", "count": count, "object_bytes": object_bytes,
+                        "store_bytes": arrow_row, "bytes_each": object_bytes + arrow_row})
+        for result in results[-3:]:
+            print(f"{result['object']} x{count}: {result['bytes_each']:.0f} bytes each", file=sys.stderr)
+    return results
+
+
+def run_allocation_benchmarks(soldiers, ticks, window, delta):
+    """Count the soldiers and arrows constructed per tick over an all archer battle that keeps getting
+    reinforced, with and without recycling them. Without it every arrow gets a new projectile row too.
+    Returns the mean constructions and arrows fired per tick of each window of ticks.
+    """
+    results = []
+    arrows = Arrow.pool()
+    for pooled in (True, False):
+        ObjectPool.ENABLED = pooled
+        ProjectilePool.REUSE_ROWS = pooled
+        battles = Battles(headless=True)
+        battles.setup(False)
+        battles.blank_slate()
+        Soldier.pool().clear()
+        Soldier.pool().reset_counts()
+        arrows.reset_counts()
+        build_scenario(battles, FORMATIONS[0], soldiers, melee_class=Archer)
+        windows = []
+        start_counts = battles.allocation_counts()
+        start_fired = 0
+        for tick in range(1, ticks + 1):
+            if tick % REINFORCE_INTERVAL == 0:
+                reinforce(battles, melee_class=Archer)
+            battles.tick(delta)
+            if tick % window == 0:
+                counts = battles.allocation_counts()
+                fired = arrows.created + arrows.reused
+                windows.append({
+                    "constructed_per_tick": {name: (counts[name] - start_counts.get(name, 0)) / window
+                                             for name in counts},
+                    "arrows_fired_per_tick": (fired - start_fired) / window,
+                })
+                start_counts, start_fired = counts, fired
+        battles.blank_slate()
+        results.append({"pooled": pooled, "windows": windows})
+        print(f"pooled={pooled}: "
+              + ", ".join(f"{sum(stats['constructed_per_tick'].values()):.2f}" for stats in windows)
+              + " constructed per tick", file=sys.stderr)
+    ObjectPool.ENABLED = True
+    ProjectilePool.REUSE_ROWS = True
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Battle scaling benchmarks, printed as JSON")
+    parser.add_argument("--counts", type=int, nargs="+", default=SOLDIER_COUNTS,
+                        help="total soldiers in each scenario")
+    parser.add_argument("--formations", nargs="+", default=FORMATIONS, help="formation types to use")
+    parser.add_argument("--ticks", type=int, default=DEFAULT_TICKS, help="ticks to run per scenario")
+    parser.add_argument("--engine", choices=BehaviorTree.ENGINES, default=BehaviorTree.ENGINE,
+                        help="how behavior trees are run")
+    parser.add_argument("--no-draw", action="store_true", help="skip timing the draw phase")
+    parser.add_argument("--diffusion", action="store_true",
+                        help="compare the speed and accuracy of the influence diffusion backends instead")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=INFLUENCE_RESOLUTIONS,
+                        help="influence grid cell sizes to compare diffusion backends at")
+    parser.add_argument("--memory", action="store_true",
+                        help="report the bytes used per soldier and per arrow in flight instead")
+    parser.add_argument("--memory-counts", type=int, nargs="+", default=MEMORY_COUNTS,
+                        help="numbers of instances to measure the memory of")
+    parser.add_argument("--allocations", action="store_true",
+                        help="count the soldiers and arrows constructed per tick in a long reinforced archery battle instead")
+    args = parser.parse_args()
+
+    if args.allocations:
+        results = run_allocation_benchmarks(ALLOCATION_SOLDIERS, ALLOCATION_TICKS, ALLOCATION_WINDOW,
+                                            DEFAULT_DELTA)
+        json.dump({"python": platform.python_version(), "soldiers": ALLOCATION_SOLDIERS,
+                   "window": ALLOCATION_WINDOW, "results": results}, sys.stdout, indent=2)
+        print()
+        return
+
+    if args.memory:
+        results = run_memory_benchmarks(args.memory_counts)
+        json.dump({"python": platform.python_version(), "numpy": numpy.__version__, "results": results},
+                  sys.stdout, indent=2)
+        print()
+        return
+
+    if args.diffusion:
+        results = run_diffusion_benchmarks(args.resolutions, DIFFUSION_REPEATS)
+        json.dump({"python": platform.python_version(), "numpy": numpy.__version__,
+                   "soldiers": DIFFUSION_SOLDIERS, "results": results}, sys.stdout, indent=2)
+        print()
+        return
+
+    draw = not args.no_draw
+    if draw:
+        # Drawing goes to an offscreen surface so no display is needed
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    BehaviorTree.ENGINE = args.engine
+
+    results = run_benchmarks(args.counts, args.formations, args.ticks, DEFAULT_DELTA, draw)
+    report = {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pygame": pygame.version.ver,
+        "engine": args.engine,
+        "ticks": args.ticks,
+        "delta": DEFAULT_DELTA,
+        "results": results,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,8 @@ class Slot:
     FONT_SIZE = 14
     ANY, FIGHTER, RANGED = range(3)
 
+    __slots__ = ("formation_offset", "type", "soldier", "color")
+
     def __init__(self, formation_type, x_off, y_off):
         self.formation_offset = Vector2(x_off, y_off)
         self.type = formation_type
@@ -86,14 +88,15 @@ class Formation(Movable):
     def draw(self, renderer, override_valid=False):
         if not self.valid and not override_valid:
             return
+        pos = self.render_pos(renderer.interpolation)
         if renderer.tactics_enabled:
             rect = Rect(0, 0, self.ANCHOR_RADIUS * 2, self.ANCHOR_RADIUS * 2)
-            rect.center = self.pos
+            rect.center = pos
             renderer.draw_rect(self.army.color, rect)
             renderer.draw_rect(Colors.black, rect, width=1)
         # Draw all the Slots
         for slot in self.slots:
-            slot.draw(renderer, self.pos)
+            slot.draw(renderer, pos)
 
     def add_soldier(self, soldier, snap_to_location=True):
         """Find the best spot for this soldier and add it to the Formation"""
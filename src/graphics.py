@@ -1,6 +1,10 @@
 """
 Classes and functions dealing with how the game should be rendered
 """
+import math
+import itertools
+import collections
+import numpy
 import pygame
 import src.util as util
 
@@ -21,6 +25,10 @@ class Renderer:
     Mostly just wraps pygame functions
     """
     BACKGROUND_COLOR = Colors.lightgray
+    # Only erase and present what was drawn, instead of the whole window every frame
+    DIRTY_RECTS = False
+    # Dirty rects are merged into runs of tiles this many pixels wide, a few big rects are cheaper than many small
+    DIRTY_TILE = 64
 
     def __init__(self, window_title, screen_size):
         self.draw = pygame.draw
@@ -28,33 +36,112 @@ class Renderer:
         self.window = pygame.display.set_mode(screen_size)
         self.tactics_enabled = True
         self.influence_enabled = True
+        # How far between the last two simulation ticks the frame being drawn is, 0 to 1
+        self.interpolation = 1.0
+        self.atlas = SpriteAtlas()
+        self.dirty_rects = self.DIRTY_RECTS
+        # Rects drawn this frame, and the tiles drawn last frame that have to be erased.
+        # The first frame clears and presents the whole window.
+        self._dirty = []
+        self._last_dirty = [self.window.get_rect()]
 
     def start_frame(self):
-        self.window.fill(self.BACKGROUND_COLOR)
+        if not self.dirty_rects:
+            self.window.fill(self.BACKGROUND_COLOR)
+            return
+        for rect in self._last_dirty:
+            self.window.fill(self.BACKGROUND_COLOR, rect)
 
     def end_frame(self):
-        pygame.display.update()
+        if not self.dirty_rects:
+            pygame.display.update()
+            return
+        tiles = self._dirty_tiles(self._dirty)
+        # Last frame's tiles were erased so they are presented too
+        pygame.display.update(self._last_dirty + tiles)
+        self._last_dirty = tiles
+        self._dirty = []
+
+    def set_dirty_rects(self, enabled):
+        """Switch dirty rect mode, the next frame clears and presents the whole window"""
+        self.dirty_rects = enabled
+        self._dirty = []
+        self._last_dirty = [self.window.get_rect()]
+
+    def _mark_dirty(self, rect):
+        if self.dirty_rects:
+            self._dirty.append(rect)
+
+    def _dirty_tiles(self, rects):
+        """Cover rects with horizontal runs of DIRTY_TILE sized tiles, one rect per run"""
+        bounds = numpy.fromiter(itertools.chain.from_iterable(rects), dtype=numpy.intp,
+                                count=len(rects) * 4).reshape(-1, 4)
+        bounds = bounds[(bounds[:, 2] > 0) & (bounds[:, 3] > 0)]
+        if not len(bounds):
+            return []
+        tile = self.DIRTY_TILE
+        columns = -(-self.window.get_width() // tile)
+        rows = -(-self.window.get_height() // tile)
+        first = bounds[:, :2] // tile
+        last = (bounds[:, :2] + bounds[:, 2:] - 1) // tile
+        first = numpy.clip(first, 0, (columns - 1, rows - 1))
+        last = numpy.clip(last, 0, (columns - 1, rows - 1)) + 1
+        # Mark every covered tile with a 2d difference array
+        marks = numpy.zeros((rows + 1, columns + 1), dtype=numpy.intp)
+        numpy.add.at(marks, (first[:, 1], first[:, 0]), 1)
+        numpy.add.at(marks, (first[:, 1], last[:, 0]), -1)
+        numpy.add.at(marks, (last[:, 1], first[:, 0]), -1)
+        numpy.add.at(marks, (last[:, 1], last[:, 0]), 1)
+        dirty = marks.cumsum(axis=0).cumsum(axis=1)[:rows, :columns] > 0
+        # Runs start where a row goes from clean to dirty and end where it goes back
+        edges = numpy.diff(numpy.pad(dirty, ((0, 0), (1, 1))).astype(numpy.int8), axis=1)
+        run_rows, starts = numpy.nonzero(edges == 1)
+        _, ends = numpy.nonzero(edges == -1)
+        return [pygame.Rect(start * tile, row * tile, (end - start) * tile, tile)
+                for row, start, end in zip(run_rows.tolist(), starts.tolist(), ends.tolist())]
 
     def draw_line(self, color, start_pos, end_pos, width=1):
-        pygame.draw.line(self.window, color, util.vec_to_ints(start_pos), util.vec_to_ints(end_pos), width)
+        self._mark_dirty(pygame.draw.line(self.window, color, util.vec_to_ints(start_pos),
+                                          util.vec_to_ints(end_pos), width))
 
     def draw_circle(self, color, position, radius, width=0):
-        pygame.draw.circle(self.window, color, util.vec_to_ints(position), radius, width)
+        self._mark_dirty(pygame.draw.circle(self.window, color, util.vec_to_ints(position), radius, width))
 
     def draw_arc(self, color, rect, start_angle, stop_angle, width=0):
-        pygame.draw.arc(self.window, color, rect, start_angle, stop_angle, width)
+        self._mark_dirty(pygame.draw.arc(self.window, color, rect, start_angle, stop_angle, width))
 
     def draw_rect(self, color, rect, width=0):
-        pygame.draw.rect(self.window, color, rect, width)
+        self._mark_dirty(pygame.draw.rect(self.window, color, rect, width))
 
     def draw_transparent_rect(self, color, rect, alpha):
         surf = ResourceManager.get_rect_surf((rect.width, rect.height), color, alpha)
-        self.window.blit(surf, rect.topleft)
+        self._mark_dirty(self.window.blit(surf, rect.topleft))
+
+    def draw_surface(self, surf, top_left):
+        self._mark_dirty(self.window.blit(surf, top_left))
+
+    def draw_sprites(self, sprites):
+        """Blit a list of (surface, top_left) pairs in one call"""
+        if self.dirty_rects:
+            self._dirty.extend(self.window.blits(sprites))
+        else:
+            self.window.blits(sprites, doreturn=False)
+
+    @staticmethod
+    def cell_surface(colors, alpha, cell_size):
+        """Render a grid of square, translucent cells to a surface to be blitted from the top left corner.
+        Colors is a (rows, columns, 3) array with the color of each cell and alpha a (rows, columns) array.
+        """
+        rows, columns = alpha.shape
+        cells = pygame.Surface((columns, rows), pygame.SRCALPHA)
+        pygame.surfarray.pixels3d(cells)[:] = colors.transpose(1, 0, 2)
+        pygame.surfarray.pixels_alpha(cells)[:] = alpha.T
+        return pygame.transform.scale(cells, (columns * cell_size, rows * cell_size))
 
     def draw_text(self, color, position, size, text):
         surf = ResourceManager.get_text_surface(text, color, size)
         top_left = position[0] - surf.get_width() / 2, position[1] - surf.get_height() / 2
-        self.window.blit(surf, top_left)
+        self._mark_dirty(self.window.blit(surf, top_left))
 
     def draw_x(self, color, position, radius, width=1):
         pos = util.vec_to_ints(position)
@@ -62,37 +149,115 @@ class Renderer:
         bottom_left = pos[0] - radius, pos[1] + radius
         top_right = pos[0] + radius, pos[1] - radius
         bottom_right = pos[0] + radius, pos[1] + radius
-        pygame.draw.line(self.window, color, top_left, bottom_right, width)
-        pygame.draw.line(self.window, color, top_right, bottom_left, width)
+        self._mark_dirty(pygame.draw.line(self.window, color, top_left, bottom_right, width))
+        self._mark_dirty(pygame.draw.line(self.window, color, top_right, bottom_left, width))
+
+
+class LruCache:
+    """Keeps the most recently used values until their total size passes a budget.
+    Counts hits, misses and evictions so the budget can be tuned.
+    """
+    def __init__(self, budget, size_of=lambda value: 1):
+        self.budget = budget
+        self.size_of = size_of
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Get the value for key, or None if it is not cached"""
+        val = self._items.get(key, None)
+        if val is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return val
+
+    def put(self, key, val):
+        """Cache a value, evicting the least recently used ones if over budget"""
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= self.size_of(old)
+        self._items[key] = val
+        self.size += self.size_of(val)
+        # Always keep the newest value, even if it is bigger than the whole budget
+        while self.size > self.budget and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= self.size_of(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._items),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+def surface_bytes(surf):
+    return surf.get_pitch() * surf.get_height()
 
 
 class ResourceManager:
     """Holds and caches already loaded resources"""
-    fonts = {}
-    text_surfs = {}
-    rect_surfs = {}
+    # Fonts are few and small, their budget is a count
+    FONT_BUDGET = 32
+    TEXT_BUDGET = 8 * 1024 * 1024
+    RECT_BUDGET = 16 * 1024 * 1024
+    # Alpha is rounded down to a multiple of this to limit the number of surfaces saved
+    ALPHA_BUCKET = 8
+
+    fonts = LruCache(FONT_BUDGET)
+    text_surfs = LruCache(TEXT_BUDGET, surface_bytes)
+    rect_surfs = LruCache(RECT_BUDGET, surface_bytes)
 
     @classmethod
     def get_font(cls, size):
         """Get or create a font object of the given size"""
         key = size
-        val = cls.fonts.get(key, None)
+        val = cls.fonts.get(key)
         if val is not None:
             return val
         font = pygame.font.Font(pygame.font.get_default_font(), size)
-        cls.fonts[key] = font
+        cls.fonts.put(key, font)
+        return font
+
+    @classmethod
+    def get_monospace_font(cls, size):
+        """Get or create a fixed width font object of the given size, used for tables"""
+        key = ("monospace", size)
+        val = cls.fonts.get(key)
+        if val is not None:
+            return val
+        font = pygame.font.SysFont("monospace", size)
+        cls.fonts.put(key, font)
         return font
 
     @classmethod
     def get_text_surface(cls, text, color, size):
         """Get or create a surface of the rendered text"""
-        key = (text, color, size)
-        val = cls.text_surfs.get(key, None)
+        key = (text, tuple(color), size)
+        val = cls.text_surfs.get(key)
         if val is not None:
             return val
         font = ResourceManager.get_font(size)
         surf = font.render(text, True, color)
-        cls.text_surfs[key] = surf
+        cls.text_surfs.put(key, surf)
         return surf
 
     @classmethod
@@ -100,14 +265,180 @@ class ResourceManager:
         """Get or create a surface of the given size and color.
         Translucency is determined by alpha.
         """
-        # Truncate alpha to int to limit number of surfaces saved
-        alpha = int(alpha)
-        key = (size, color, alpha)
-        val = cls.fonts.get(key, None)
+        # Quantize alpha to limit number of surfaces saved
+        alpha = min(int(alpha) // cls.ALPHA_BUCKET * cls.ALPHA_BUCKET, 255)
+        key = (tuple(size), tuple(color), alpha)
+        val = cls.rect_surfs.get(key)
         if val is not None:
             return val
         surf = pygame.Surface(size)
         surf.set_alpha(alpha)
         surf.fill(color)
-        cls.rect_surfs[key] = surf
+        cls.rect_surfs.put(key, surf)
         return surf
+
+    @classmethod
+    def stats(cls):
+        """Counters of every cache, see LruCache.stats"""
+        return {
+            "fonts": cls.fonts.stats(),
+            "text_surfs": cls.text_surfs.stats(),
+            "rect_surfs": cls.rect_surfs.stats(),
+        }
+
+    @classmethod
+    def clear(cls):
+        cls.fonts.clear()
+        cls.text_surfs.clear()
+        cls.rect_surfs.clear()
+
+
+class SpriteAtlas:
+    """Pre-rendered sprites for things drawn many times a frame, like soldiers and weapons.
+    Continuous values like health and angle are bucketed so a small set of sprites covers everything.
+    Sprites are (surface, offset) pairs, offset is where the top left goes relative to the drawn position.
+    """
+    BUDGET = 32 * 1024 * 1024
+    HEALTH_BUCKETS = 16
+    ANGLE_BUCKETS = 72
+    OUTLINE_COLOR = Colors.black
+
+    def __init__(self):
+        self.sprites = LruCache(self.BUDGET, lambda sprite: surface_bytes(sprite[0]))
+        self.tables = {}
+
+    @classmethod
+    def angle_bucket(cls, angle):
+        return int(round(angle * cls.ANGLE_BUCKETS / 360)) % cls.ANGLE_BUCKETS
+
+    @classmethod
+    def angle_buckets(cls, angles):
+        """Vectorized angle_bucket"""
+        return numpy.rint(numpy.asarray(angles) * cls.ANGLE_BUCKETS / 360).astype(numpy.intp) % cls.ANGLE_BUCKETS
+
+    @classmethod
+    def bucket_angle(cls, bucket):
+        """The angle a bucket's sprite is drawn with"""
+        return bucket * 360 / cls.ANGLE_BUCKETS
+
+    def get(self, key, render):
+        """Get the sprite for key, calling render() to make it the first time"""
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = self.trim(*render())
+            self.sprites.put(key, sprite)
+        return sprite
+
+    @staticmethod
+    def trim(surf, offset):
+        """Cut a sprite down to its visible pixels, in the screen's format when there is one.
+        Blitting skips all the transparent padding the sprite was drawn with.
+        """
+        rect = surf.get_bounding_rect()
+        trimmed = surf.subsurface(rect).copy()
+        if pygame.display.get_surface() is not None:
+            trimmed = trimmed.convert_alpha()
+        return trimmed, (offset[0] + rect.x, offset[1] + rect.y)
+
+    def table(self, name, render):
+        """The SpriteTable with the given name, made with render the first time"""
+        table = self.tables.get(name, None)
+        if table is None:
+            table = SpriteTable(render)
+            self.tables[name] = table
+        return table
+
+    @staticmethod
+    def blank(half_size):
+        """Transparent square surface with the drawn position at its center"""
+        size = half_size * 2 + 1
+        return pygame.Surface((size, size), pygame.SRCALPHA)
+
+    def body(self, color, health_factor, radius):
+        """Soldier body, its color darkened by health"""
+        health_bucket = min(max(int(round(health_factor * self.HEALTH_BUCKETS)), 0), self.HEALTH_BUCKETS)
+        key = ("body", tuple(color), health_bucket, radius)
+
+        def render():
+            factor = health_bucket / self.HEALTH_BUCKETS
+            current_color = [max(int(part * factor), 0) for part in color]
+            center = radius + 1
+            surf = self.blank(center)
+            pygame.draw.circle(surf, current_color, (center, center), radius)
+            pygame.draw.circle(surf, self.OUTLINE_COLOR, (center, center), radius, 1)
+            return surf, (-center, -center)
+
+        return self.get(key, render)
+
+    def line(self, color, angle, start_dist, end_dist, width):
+        """Line pointing out from the drawn position at angle, like a sword or arrow"""
+        angle_bucket = self.angle_bucket(angle)
+        key = ("line", tuple(color), angle_bucket, start_dist, end_dist, width)
+
+        def render():
+            center = int(end_dist) + width + 1
+            surf = self.blank(center)
+            norm = pygame.Vector2(0, -1)
+            norm.rotate_ip(self.bucket_angle(angle_bucket))
+            middle = pygame.Vector2(center, center)
+            pygame.draw.line(surf, color, util.vec_to_ints(middle + norm * start_dist),
+                             util.vec_to_ints(middle + norm * end_dist), width)
+            return surf, (-center, -center)
+
+        return self.get(key, render)
+
+    def arc(self, color, angle, dist, size, curve, width):
+        """Arc of a circle whose center is dist away from the drawn position at angle, like a bow"""
+        angle_bucket = self.angle_bucket(angle)
+        key = ("arc", tuple(color), angle_bucket, dist, size, curve, width)
+
+        def render():
+            center = int(dist + size / 2) + 2
+            surf = self.blank(center)
+            bucket_angle = self.bucket_angle(angle_bucket)
+            norm = pygame.Vector2(0, -1)
+            norm.rotate_ip(bucket_angle)
+            rect = pygame.Rect(0, 0, size, size)
+            rect.center = pygame.Vector2(center, center) + norm * dist
+            rads = math.radians(bucket_angle)
+            fix = math.pi * 0.5
+            pygame.draw.arc(surf, color, rect, fix - rads - curve, fix - rads + curve, width)
+            return surf, (-center, -center)
+
+        return self.get(key, render)
+
+
+class SpriteTable:
+    """Sprites for many things of one kind, each look numbered by a small integer code.
+    A sprite is made the first time its code is used, after that whole arrays of codes
+    are looked up with plain indexing. Codes should be dense, the table is as long as the biggest one.
+    """
+    def __init__(self, render):
+        # code -> (surface, offset)
+        self.render = render
+        self.surfaces = numpy.empty(0, dtype=object)
+        self.offsets = numpy.zeros((0, 2), dtype=numpy.intp)
+        self.ready = numpy.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.ready)
+
+    def _grow(self, size):
+        old = len(self.ready)
+        self.surfaces = numpy.concatenate((self.surfaces, numpy.empty(size - old, dtype=object)))
+        self.offsets = numpy.concatenate((self.offsets, numpy.zeros((size - old, 2), dtype=numpy.intp)))
+        self.ready = numpy.concatenate((self.ready, numpy.zeros(size - old, dtype=bool)))
+
+    def lookup(self, codes):
+        """Object array of the surface for every code, and an (n, 2) array of their offsets"""
+        if not codes.size:
+            return self.surfaces[:0], self.offsets[:0]
+        size = int(codes.max()) + 1
+        if size > len(self.ready):
+            self._grow(size)
+        missing = codes[~self.ready[codes]]
+        if len(missing):
+            for code in numpy.unique(missing).tolist():
+                self.surfaces[code], self.offsets[code] = self.render(code)
+                self.ready[code] = True
+        return self.surfaces[codes], self.offsets[codes]
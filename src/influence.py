@@ -2,9 +2,133 @@
 Code related to user interface
 """
 
-import pygame
+from concurrent.futures import ThreadPoolExecutor
 import numpy
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, uniform_filter1d
+from scipy.signal import fftconvolve
+
+
+def gaussian_weights(sigma, truncate):
+    """Normalized 1D gaussian kernel, the same one scipy's gaussian_filter uses"""
+    radius = int(truncate * sigma + 0.5)
+    offsets = numpy.arange(-radius, radius + 1)
+    weights = numpy.exp(-0.5 * (offsets / sigma) ** 2)
+    return weights / weights.sum()
+
+
+class Diffusion:
+    """Spreads the influence in a stack of maps out to nearby cells.
+    Approximates a gaussian blur where everything off the map counts as zero.
+    """
+    # gaussian_filter's default, the kernel reaches 4 sigma out
+    DEFAULT_TRUNCATE = 4.0
+
+    def __init__(self, sigma, shape, truncate=DEFAULT_TRUNCATE):
+        self.sigma = sigma
+        self.shape = shape
+        self.truncate = truncate
+
+    def apply(self, maps, out):
+        """Diffuse maps, an (armies, rows, columns) array, into out"""
+        raise NotImplementedError()
+
+
+class GaussianDiffusion(Diffusion):
+    """Reference implementation, a full gaussian filter of every map in turn"""
+    def apply(self, maps, out):
+        for layer, base_map in enumerate(maps):
+            gaussian_filter(base_map, sigma=self.sigma, output=out[layer], mode="constant",
+                            truncate=self.truncate)
+
+
+class SeparableDiffusion(Diffusion):
+    """The gaussian split into a row pass and a column pass.
+    Each pass is a precomputed banded matrix, so all the maps are blurred with two matrix products.
+    A smaller truncate gives a narrower band.
+    """
+    def __init__(self, sigma, shape, truncate=Diffusion.DEFAULT_TRUNCATE):
+        super(SeparableDiffusion, self).__init__(sigma, shape, truncate)
+        weights = gaussian_weights(sigma, truncate)
+        self._row_matrix = self._band_matrix(weights, shape[0])
+        self._column_matrix = self._band_matrix(weights, shape[1]).T.copy()
+
+    @staticmethod
+    def _band_matrix(weights, size):
+        """Matrix that convolves a vector of the given size with weights, zero padded"""
+        radius = len(weights) // 2
+        offsets = numpy.arange(size)[numpy.newaxis, :] - numpy.arange(size)[:, numpy.newaxis]
+        matrix = numpy.zeros((size, size))
+        in_band = numpy.abs(offsets) <= radius
+        matrix[in_band] = weights[offsets[in_band] + radius]
+        return matrix
+
+    def apply(self, maps, out):
+        numpy.matmul(self._row_matrix, maps, out=out)
+        numpy.matmul(out, self._column_matrix, out=out)
+
+
+class FFTDiffusion(Diffusion):
+    """Convolution with the full 2D kernel through FFTs, the cost barely grows with sigma.
+    Pays off on fine grids where the kernel covers many cells.
+    """
+    def __init__(self, sigma, shape, truncate=Diffusion.DEFAULT_TRUNCATE):
+        super(FFTDiffusion, self).__init__(sigma, shape, truncate)
+        weights = gaussian_weights(sigma, truncate)
+        # Parts of the kernel further out than the map is big never land on the map
+        radius = len(weights) // 2
+        row_weights = weights[max(radius - shape[0] + 1, 0):len(weights) - max(radius - shape[0] + 1, 0)]
+        column_weights = weights[max(radius - shape[1] + 1, 0):len(weights) - max(radius - shape[1] + 1, 0)]
+        self._kernel = numpy.outer(row_weights, column_weights)[numpy.newaxis]
+
+    def apply(self, maps, out):
+        if len(maps):
+            out[:] = fftconvolve(maps, self._kernel, mode="same", axes=(1, 2))
+
+
+class BoxDiffusion(Diffusion):
+    """Approximates the gaussian with repeated box blurs of a matching variance.
+    Each pass costs the same no matter how wide the blur is.
+    """
+    PASSES = 3
+
+    def __init__(self, sigma, shape, truncate=Diffusion.DEFAULT_TRUNCATE):
+        super(BoxDiffusion, self).__init__(sigma, shape, truncate)
+        # n boxes of width w have a variance of n * (w^2 - 1) / 12, use the closest odd width
+        width = numpy.sqrt(12 * sigma ** 2 / self.PASSES + 1)
+        self.width = max(int(width // 2) * 2 + 1, 1)
+        # Influence spread off the map by one pass has to be there for the next pass to bring back
+        self._pad = self.PASSES * (self.width // 2)
+        self._padded = None
+
+    def apply(self, maps, out):
+        pad = self._pad
+        padded_shape = (len(maps), self.shape[0] + 2 * pad, self.shape[1] + 2 * pad)
+        if self._padded is None or self._padded.shape != padded_shape:
+            self._padded = numpy.zeros(padded_shape)
+        padded = self._padded
+        padded.fill(0)
+        padded[:, pad:pad + self.shape[0], pad:pad + self.shape[1]] = maps
+        for _ in range(self.PASSES):
+            for axis in (1, 2):
+                uniform_filter1d(padded, self.width, axis=axis, output=padded, mode="constant")
+        out[:] = padded[:, pad:pad + self.shape[0], pad:pad + self.shape[1]]
+
+
+class InfluenceLayers:
+    """The arrays that one set of influence maps is built in.
+    Reused from update to update as long as the armies stay the same.
+    """
+    def __init__(self, army_ids, rows, columns):
+        self.army_ids = army_ids
+        self.army_rows = {army_id: row for row, army_id in enumerate(army_ids)}
+        # The extra last layer collects soldiers whose army is not on the map, they count as enemies
+        self.occupancy = numpy.zeros((len(army_ids) + 1, rows, columns))
+        self.total = numpy.zeros((rows, columns))
+        # Occupancy as of the last diffusion, NaN forces the next update to diffuse
+        self.diffused_occupancy = numpy.full_like(self.occupancy, numpy.nan)
+        self.base_maps = numpy.zeros((len(army_ids), rows, columns))
+        self.diffused = numpy.zeros((len(army_ids), rows, columns))
+        self.maps = {army_id: self.diffused[row] for row, army_id in enumerate(army_ids)}
 
 
 class InfluenceMap:
@@ -16,79 +140,299 @@ class InfluenceMap:
     MAX_INFLUENCE = 0.01
     MAX_INFLUENCE_ALPHA = 150
 
-    def __init__(self, screen_size, soldiers, armies):
+    GAUSSIAN = "gaussian"
+    SEPARABLE = "separable"
+    FFT = "fft"
+    BOX = "box"
+    DIFFUSIONS = {
+        GAUSSIAN: GaussianDiffusion,
+        SEPARABLE: SeparableDiffusion,
+        FFT: FFTDiffusion,
+        BOX: BoxDiffusion,
+    }
+    # Which backend new maps diffuse with
+    DIFFUSION = SEPARABLE
+    # Diffuse at least every this many updates, at 1 every update diffuses and the threshold never matters
+    DIFFUSION_INTERVAL = 1
+    # Also diffuse early once this fraction of the total influence has changed cells, None to disable
+    OCCUPANCY_CHANGE_THRESHOLD = 0.05
+    # Whether new maps are computed on a worker thread, see _update_async
+    ASYNCHRONOUS = False
+
+    def __init__(self, screen_size, soldiers, armies, grid_resolution=GRID_RESOLUTION, diffusion=None,
+                 asynchronous=None):
         self.screen_size = screen_size
         self.soldiers = soldiers
         self.armies = armies
-        self._maps = self._blank_maps()
+        self.grid_resolution = grid_resolution
+        self.rows = int(self.screen_size[1] // grid_resolution)
+        self.columns = int(self.screen_size[0] // grid_resolution)
+        # Sigma is in cells, keep the blur the same size in the world for other resolutions
+        sigma = self.CONVOLUTION_SIGMA * self.GRID_RESOLUTION / grid_resolution
+        diffusion_class = self.DIFFUSIONS[diffusion or self.DIFFUSION]
+        self.diffusion = diffusion_class(sigma, (self.rows, self.columns))
+        self.asynchronous = self.ASYNCHRONOUS if asynchronous is None else asynchronous
+        self._updates_since_diffusion = 0
+        # Bumped every time the maps change, so drawing knows when to re-render
+        self._version = 0
+        self._surface_key = None
+        self._surface = None
+        # The maps that are drawn and read, only ever replaced as a whole
+        self._layers = InfluenceLayers((), self.rows, self.columns)
+        # Asynchronous mode builds the next maps here while the current ones are read
+        self._back_layers = None
+        self._executor = None
+        self._pending = None
+        # Derived from the current maps, rebuilt when the version changes
+        self._gradients = None
+        self._gradients_version = None
+        self._frontlines = {}
+        self._frontlines_version = None
+
+    @property
+    def layers(self):
+        """The arrays the current maps are built in, the next update may change or replace them"""
+        return self._layers
+
+    @property
+    def _maps(self):
+        return self._layers.maps
+
+    @property
+    def _base_maps(self):
+        return self._layers.base_maps
+
+    @property
+    def _diffused(self):
+        return self._layers.diffused
 
-    def _blank_maps(self):
-        """Create a blank set of maps, one for each army"""
-        self.rows = int(self.screen_size[1] // self.GRID_RESOLUTION)
-        self.columns = int(self.screen_size[0] // self.GRID_RESOLUTION)
+    def _layers_for(self, layers, army_ids):
+        """Reuse layers if they are for the given armies, otherwise make new ones"""
+        if layers is not None and layers.army_ids == army_ids:
+            return layers
+        return InfluenceLayers(army_ids, self.rows, self.columns)
 
-        new_maps = {}
-        for army_id in self.armies.keys():
-            new_maps[army_id] = numpy.zeros((self.rows, self.columns))
-        return new_maps
+    def _layer_rows(self, army_ids, count):
+        """Layer of each army in the current maps, -1 for armies that are not on them"""
+        army_rows = self._layers.army_rows
+        if numpy.ndim(army_ids) == 0:
+            return numpy.full(count, army_rows.get(army_ids, -1), dtype=numpy.intp)
+        return numpy.fromiter((army_rows.get(army_id, -1) for army_id in army_ids), dtype=numpy.intp,
+                              count=count)
+
+    def _bilinear(self, grids, army_ids, positions):
+        """Sample (armies, rows, columns) grids at world positions, interpolating between cell centers.
+        Positions off the map take the value of the closest edge, armies not on the map get 0.
+        """
+        positions = numpy.asarray(positions, dtype=float).reshape(-1, 2)
+        layers = self._layer_rows(army_ids, len(positions))
+        values = numpy.zeros(len(positions))
+        known = layers >= 0
+        if not known.any():
+            return values
+        layers, positions = layers[known], positions[known]
+        x_pos = numpy.clip(positions[:, 0] / self.grid_resolution - 0.5, 0, self.columns - 1)
+        y_pos = numpy.clip(positions[:, 1] / self.grid_resolution - 0.5, 0, self.rows - 1)
+        col0 = x_pos.astype(numpy.intp)
+        row0 = y_pos.astype(numpy.intp)
+        col1 = numpy.minimum(col0 + 1, self.columns - 1)
+        row1 = numpy.minimum(row0 + 1, self.rows - 1)
+        x_frac = x_pos - col0
+        y_frac = y_pos - row0
+        top = grids[layers, row0, col0] * (1 - x_frac) + grids[layers, row0, col1] * x_frac
+        bottom = grids[layers, row1, col0] * (1 - x_frac) + grids[layers, row1, col1] * x_frac
+        values[known] = top * (1 - y_frac) + bottom * y_frac
+        return values
+
+    def sample(self, positions, army_ids):
+        """Influence at each (x, y) position for the army of the same index.
+        army_ids can also be a single id used for every position.
+        """
+        return self._bilinear(self._diffused, army_ids, positions)
+
+    def gradients(self):
+        """Slope of every army's map, a (2, armies, rows, columns) array of d/dx and d/dy per pixel"""
+        if self._gradients_version != self._version:
+            diffused = self._diffused
+            if diffused.size:
+                d_row, d_col = numpy.gradient(diffused, self.grid_resolution, axis=(1, 2))
+                self._gradients = numpy.stack((d_col, d_row))
+            else:
+                self._gradients = numpy.zeros((2,) + diffused.shape)
+            self._gradients_version = self._version
+        return self._gradients
+
+    def sample_gradient(self, positions, army_ids):
+        """Direction of increasing influence at each position, an (n, 2) array of (dx, dy)"""
+        x_grad, y_grad = self.gradients()
+        return numpy.column_stack((self._bilinear(x_grad, army_ids, positions),
+                                   self._bilinear(y_grad, army_ids, positions)))
+
+    def frontline(self, army_id):
+        """Centers of the cells the army holds that border a cell it does not, an (n, 2) array"""
+        if self._frontlines_version != self._version:
+            self._frontlines = {}
+            self._frontlines_version = self._version
+        front = self._frontlines.get(army_id, None)
+        if front is None:
+            army_map = self._maps.get(army_id, None)
+            if army_map is None:
+                return numpy.zeros((0, 2))
+            held = army_map > 0
+            # Pad with held cells so the edge of the map does not count as a border
+            padded = numpy.pad(held, 1, mode="edge")
+            bordering = ~padded[:-2, 1:-1] | ~padded[2:, 1:-1] | ~padded[1:-1, :-2] | ~padded[1:-1, 2:]
+            rows, cols = numpy.nonzero(held & bordering)
+            front = (numpy.column_stack((cols, rows)) + 0.5) * self.grid_resolution
+            self._frontlines[army_id] = front
+        return front
 
     def position_to_grid(self, position):
         """Find the grid square that this position falls in"""
-        row = int(position.y // self.GRID_RESOLUTION)
-        col = int(position.x // self.GRID_RESOLUTION)
+        row = int(position.y // self.grid_resolution)
+        col = int(position.x // self.grid_resolution)
         return row, col
 
     def update(self):
-        """Run the convolution to update the influence map"""
-        self._update_maps()
-        self._apply_convolution()
-
-    def _update_maps(self):
-        """Update our maps based on the current position of the soldiers"""
-        self._maps = self._blank_maps()
-        for soldier in self.soldiers.values():
-            if not soldier.is_alive():
-                continue
-            row, col = self.position_to_grid(soldier.pos)
-            if row < 0 or row >= self.rows or col < 0 or col >= self.columns:
-                # Out of bounds
-                continue
-            for army_id, army_map in self._maps.items():
-                # +1 for this army, -1 for an enemy
-                influence_val = 1.0 if army_id is soldier.army.my_id else -1.0
-                army_map[row][col] += influence_val
-
-    def _apply_convolution(self):
-        """Apply the gaussian filter to the maps to spread out the influence"""
-        for army_id, base_map in self._maps.items():
-            self._maps[army_id] = gaussian_filter(base_map, sigma=self.CONVOLUTION_SIGMA,
-                                                  mode="constant")
+        """Run the convolution to update the influence map.
+        The splat is done every update, diffusion only when it is due or soldiers moved enough.
+        """
+        if self.asynchronous:
+            self._update_async()
+            return
+
+        army_ids = tuple(self.armies.keys())
+        layers = self._layers_for(self._layers, army_ids)
+        if layers is not self._layers:
+            self._layers = layers
+            self._version += 1
+        self._update_maps(layers, self._snapshot(army_ids))
+        self._updates_since_diffusion += 1
+        if self._diffusion_due(layers):
+            self._apply_convolution(layers)
+            self._version += 1
+
+    def _update_async(self):
+        """Publish the maps the worker thread finished, then start on the next ones.
+        Positions are copied on the main thread, everything after that happens on the worker.
+        Nothing here waits on the worker, while it is busy the current maps are kept.
+        """
+        if self._pending is not None:
+            if not self._pending.done():
+                return
+            finished = self._pending.result()
+            self._pending = None
+            # Swap, the old front layers are reused for the next update
+            self._back_layers, self._layers = self._layers, finished
+            self._version += 1
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="influence")
+        army_ids = tuple(self.armies.keys())
+        layers = self._layers_for(self._back_layers, army_ids)
+        self._back_layers = None
+        self._pending = self._executor.submit(self._build_layers, layers, self._snapshot(army_ids))
+
+    def _build_layers(self, layers, snapshot):
+        """Worker thread, fills the given layers with new maps.
+        Runs without the throttle since a new update only starts once the last one is done.
+        """
+        self._update_maps(layers, snapshot)
+        self._apply_convolution(layers)
+        return layers
+
+    def close(self):
+        """Stop the worker thread, if there is one"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pending = None
+
+    def _diffusion_due(self, layers):
+        if self._updates_since_diffusion >= self.DIFFUSION_INTERVAL:
+            return True
+        if self.OCCUPANCY_CHANGE_THRESHOLD is None:
+            return False
+        total = numpy.abs(layers.occupancy).sum()
+        # Every unit of influence that moves leaves one cell and enters another
+        moved = numpy.abs(layers.occupancy - layers.diffused_occupancy).sum() / 2
+        return not moved <= self.OCCUPANCY_CHANGE_THRESHOLD * total
+
+    def _snapshot(self, army_ids):
+        """Copy what the splat needs from the living soldiers on the map.
+        Returns the flat occupancy cell and weight of each soldier.
+        """
+        soldiers = list(self.soldiers.values())
+        if not soldiers:
+            return numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0)
+        count = len(soldiers)
+        army_rows = {army_id: row for row, army_id in enumerate(army_ids)}
+        unknown = len(army_ids)
+        store = soldiers[0].store()
+        slots = numpy.fromiter((soldier.slot for soldier in soldiers), dtype=numpy.intp, count=count)
+        layers = numpy.fromiter((army_rows.get(soldier.army.my_id, unknown) for soldier in soldiers),
+                                dtype=numpy.intp, count=count)
+        weights = numpy.fromiter((soldier.influence for soldier in soldiers), dtype=float, count=count)
+
+        positions = store.pos[slots]
+        rows = (positions[:, 1] // self.grid_resolution).astype(numpy.intp)
+        cols = (positions[:, 0] // self.grid_resolution).astype(numpy.intp)
+        keep = (store.health[slots] > 0) & (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.columns)
+        cells = (layers[keep] * self.rows + rows[keep]) * self.columns + cols[keep]
+        return cells, weights[keep]
+
+    @staticmethod
+    def _update_maps(layers, snapshot):
+        """Update the maps based on a snapshot of the soldiers.
+        Each soldier adds its influence to its army's occupancy grid, then every army's map is
+        its own occupancy minus everyone else's.
+        """
+        cells, weights = snapshot
+        layers.occupancy.fill(0)
+        numpy.add.at(layers.occupancy.reshape(-1), cells, weights)
+
+        numpy.sum(layers.occupancy, axis=0, out=layers.total)
+        # own - (total - own)
+        numpy.multiply(layers.occupancy[:-1], 2, out=layers.base_maps)
+        numpy.subtract(layers.base_maps, layers.total, out=layers.base_maps)
+
+    def _apply_convolution(self, layers):
+        """Apply the diffusion backend to the maps to spread out the influence"""
+        self.diffusion.apply(layers.base_maps, layers.diffused)
+        numpy.copyto(layers.diffused_occupancy, layers.occupancy)
+        self._updates_since_diffusion = 0
 
     def draw(self, renderer):
-        """Draw the current influence map to the screen"""
+        """Draw the current influence map to the screen.
+        The cells are rendered into one translucent, screen sized surface whenever the maps
+        change, so every frame is a single blit however fine the grid is.
+        """
         if not self._maps or not renderer.influence_enabled:
             return
 
-        # Find the influence value for each square
-        for row in range(self.rows):
-            for col in range(self.columns):
-                # Find which army has the highest influence here
-                best = None
-                influence = 0.0
-                for army_id, army_map in self._maps.items():
-                    if army_map[row][col] > influence:
-                        # This is the new highest influence for this square
-                        influence = army_map[row][col]
-                        best = army_id
-                if best is not None:
-                    self._draw_army_influence_at(renderer, row, col, best, influence)
-
-    def _draw_army_influence_at(self, renderer, row, col, army_id, influence):
-        """Draw the square the proper color and translucency based on influence"""
-        army_color = self.armies[army_id].color
-        influence_percent = min(influence / self.MAX_INFLUENCE, 1.0)
-        alpha = self.MAX_INFLUENCE_ALPHA * influence_percent
-        rect = pygame.Rect(col * self.GRID_RESOLUTION, row * self.GRID_RESOLUTION,
-                           self.GRID_RESOLUTION, self.GRID_RESOLUTION)
-        renderer.draw_transparent_rect(army_color, rect, alpha)
+        colors = tuple(tuple(self.armies[army_id].color[:3]) if army_id in self.armies else None
+                       for army_id in self._layers.army_ids)
+        surface_key = (self._version, colors)
+        if surface_key != self._surface_key:
+            self._surface = renderer.cell_surface(*self._cell_colors(colors), self.grid_resolution)
+            self._surface_key = surface_key
+        renderer.draw_surface(self._surface, (0, 0))
+
+    def _cell_colors(self, colors):
+        """Color each cell by the army with the most influence there, more opaque the stronger it is.
+        Returns a (rows, columns, 3) array of the cell colors and a (rows, columns) array of their alpha.
+        """
+        # Armies that are gone by now are left fully transparent
+        army_colors = numpy.array([(0, 0, 0) if color is None else color for color in colors], dtype=numpy.uint8)
+        gone = numpy.array([color is None for color in colors])
 
+        # Same as argmax over the armies, which is slow across the first axis
+        best = numpy.zeros(self._diffused.shape[1:], dtype=numpy.intp)
+        influence = self._diffused[0].copy()
+        for army, diffused in enumerate(self._diffused[1:], 1):
+            numpy.copyto(best, army, where=diffused > influence)
+            numpy.maximum(influence, diffused, out=influence)
+        alpha = numpy.floor(self.MAX_INFLUENCE_ALPHA * numpy.minimum(influence / self.MAX_INFLUENCE, 1.0))
+        # Only cells where some army has positive influence are colored
+        alpha[(influence <= 0) | gone[best]] = 0
+        return army_colors.take(best, axis=0), alpha.astype(numpy.uint8)
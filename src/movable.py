@@ -1,57 +1,107 @@
 """
 Class that represents an objects position and orientation in the world
 """
-
+import copy
+import weakref
 from pygame import Vector2
 import src.util as util
+from src.state import StateStore, vector_property, scalar_property
 
 
 class Movable:
-    """Abstract class used by things that move and are steerable"""
+    """Abstract class used by things that move and are steerable.
+    State lives in a row of the class's StateStore, the attributes are views into it.
+    Vector attributes like pos read as copies, assign a whole new vector to change them.
+    Subclasses list their own attributes in __slots__ to skip the per instance __dict__,
+    ones that don't still work and get a __dict__.
+    """
+    __slots__ = ("_slot", "_finalizer", "__weakref__")
+    _store = StateStore()
+
+    pos = vector_property("pos")
+    velocity = vector_property("velocity")
+    velocity_steering = vector_property("velocity_steering")
+    max_velocity = scalar_property("max_velocity")
+    max_vel_accel = scalar_property("max_vel_accel")
+    facing = scalar_property("facing")
+    rotation = scalar_property("rotation")
+    rotation_steering = scalar_property("rotation_steering")
+    max_rotation = scalar_property("max_rotation")
+    max_rot_accel = scalar_property("max_rot_accel")
+    stationary_timer = scalar_property("stationary_timer")
+
+    @classmethod
+    def store(cls):
+        """Gets the StateStore holding the state of this class of Movable"""
+        return cls._store
+
     def __init__(self):
-        self.pos = Vector2()
-        self.velocity = Vector2()
-        self.velocity_steering = Vector2()
+        self._attach()
+        self.reset()
+
+    def reset(self):
+        """Put the state back to how it is right after construction, keeping the store slot"""
+        self._store.clear_slot(self._slot)
         self.max_velocity = 0
         self.max_vel_accel = 60
-        self.facing = 0
-        self.rotation = 0
-        self.rotation_steering = 0
         self.max_rotation = 0
         self.max_rot_accel = 80
-        self.stationary_timer = 0
+
+    def _attach(self):
+        """Take a slot in the store, it is given back once this Movable is garbage collected"""
+        self._slot = self._store.allocate()
+        self._finalizer = weakref.finalize(self, self._store.release, self._slot)
+
+    def __deepcopy__(self, memo):
+        clone = self.__class__.__new__(self.__class__)
+        memo[id(self)] = clone
+        for key, val in self._attributes():
+            setattr(clone, key, copy.deepcopy(val, memo))
+        clone._attach()
+        self._store.copy_slot(self._slot, clone._slot)
+        return clone
+
+    def _attributes(self):
+        """(name, value) of every attribute set on this instance, in slots or the __dict__.
+        The store slot is left out, it can't be shared.
+        """
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if name not in ("_slot", "_finalizer", "__weakref__", "__dict__") and hasattr(self, name):
+                    yield name, getattr(self, name)
+        yield from getattr(self, "__dict__", {}).items()
+
+    @property
+    def slot(self):
+        """Row of the store holding this Movable's state"""
+        return self._slot
 
     def set_position(self, x_pos, y_pos, facing=None):
-        self.pos.x = x_pos
-        self.pos.y = y_pos
+        # Placing something moves it instantly, there is nothing to interpolate from
+        self._store.pos[self._slot] = (x_pos, y_pos)
+        self._store.prev_pos[self._slot] = (x_pos, y_pos)
         if facing is not None:
             self.facing = facing
+            self._store.prev_facing[self._slot] = facing
+
+    def render_pos(self, interpolation):
+        """Position to draw at, interpolated between the last two simulation ticks"""
+        prev_pos = self._store.prev_pos[self._slot]
+        pos = prev_pos + (self._store.pos[self._slot] - prev_pos) * interpolation
+        return Vector2(*pos.tolist())
+
+    def render_facing(self, interpolation):
+        """Facing to draw with, interpolated between the last two simulation ticks"""
+        prev_facing = self._store.prev_facing.item(self._slot)
+        turned = util.normalize_rotation(self.facing - prev_facing)
+        return util.normalize_rotation(prev_facing + turned * interpolation)
 
     def reset_steering(self):
-        self.velocity_steering.x = 0
-        self.velocity_steering.y = 0
-        self.rotation_steering = 0
+        self._store.reset_steering(self._slot)
 
     def handle_steering(self, delta):
         """Apply the current steering values to move this moveable"""
-        # Velocity
-        # Don't move if we are temporarily stationary
-        if self.stationary_timer <= 0:
-            if self.velocity_steering.length() > self.max_vel_accel:
-                self.velocity_steering.scale_to_length(self.max_vel_accel)
-            self.velocity += self.velocity_steering
-            if self.velocity.length() > self.max_velocity:
-                self.velocity.scale_to_length(self.max_velocity)
-            self.pos += self.velocity * delta
-
-        # Rotation
-        if self.rotation_steering > self.max_rot_accel:
-            self.rotation_steering = self.max_rot_accel
-        self.rotation += self.rotation_steering
-        if abs(self.rotation) > self.max_rotation:
-            self.rotation = self.max_rotation * (self.rotation / abs(self.rotation))
-        self.facing += self.rotation * delta
-        self.facing = util.normalize_rotation(self.facing)
+        self._store.handle_steering(delta, [self._slot])
 
     def add_velocity_steering(self, steering):
         if steering.length() > self.max_vel_accel:
@@ -70,4 +120,3 @@ class Movable:
         facing.rotate_ip(self.facing)
         rotation = facing.angle_to(direction)
         return util.normalize_rotation(rotation)
-
@@ -0,0 +1,52 @@
+"""
+Pools that recycle game objects instead of constructing new ones
+"""
+import collections
+
+
+class ObjectPool:
+    """Keeps released objects, by class, so they can be handed out again instead of constructing new ones.
+    Pooled classes have a reset() hook that puts an object back the way it was when it was constructed.
+    Counts the objects constructed and reused so allocations can be watched.
+    """
+    # Turn off to construct every object, for comparing allocations
+    ENABLED = True
+
+    def __init__(self):
+        self._free = collections.defaultdict(list)
+        self.created = collections.Counter()
+        self.reused = collections.Counter()
+
+    def __len__(self):
+        """Number of objects waiting to be reused"""
+        return sum(len(objs) for objs in self._free.values())
+
+    def acquire(self, cls):
+        """A reset object of the given class, recycled if there is one"""
+        free = self._free.get(cls, None)
+        if free:
+            obj = free.pop()
+            obj.reset()
+            self.reused[cls.__name__] += 1
+            return obj
+        self.created[cls.__name__] += 1
+        return cls()
+
+    def release(self, obj):
+        """Hand an object back, nothing else may use it from now on"""
+        if self.ENABLED:
+            self._free[obj.__class__].append(obj)
+
+    def clear(self):
+        self._free.clear()
+
+    def reset_counts(self):
+        self.created.clear()
+        self.reused.clear()
+
+    def stats(self):
+        return {
+            "created": dict(self.created),
+            "reused": dict(self.reused),
+            "free": {cls.__name__: len(objs) for cls, objs in self._free.items()},
+        }
@@ -0,0 +1,145 @@
+"""
+Per-phase frame timing, used to find what is blowing the frame budget
+"""
+import time
+import contextlib
+import numpy
+import pygame
+from src.graphics import Colors, ResourceManager
+
+
+class FrameProfiler:
+    """Times the phases of every frame and keeps the last HISTORY frames in ring buffers.
+    Phases can run any number of times per frame, their times are added up.
+    """
+    EVENTS = "events"
+    ARMY_UPDATE = "army update"
+    SOLDIER_UPDATE = "soldier update"
+    INTERACTIONS = "interactions"
+    CLEANUP = "cleanup"
+    INFLUENCE_UPDATE = "influence update"
+    INFLUENCE_DRAW = "influence draw"
+    SOLDIER_DRAW = "soldier draw"
+    UI = "ui"
+    PRESENT = "present"
+    PHASES = (EVENTS, ARMY_UPDATE, SOLDIER_UPDATE, INTERACTIONS, CLEANUP, INFLUENCE_UPDATE,
+              INFLUENCE_DRAW, SOLDIER_DRAW, UI, PRESENT)
+    # Sum of every phase
+    TOTAL = "total"
+    PERCENTILES = (50, 95, 99)
+
+    HISTORY = 300
+    BUDGET_MS = 1000 / 60
+
+    OVERLAY_TEXT_SIZE = 14
+    OVERLAY_LINE_HEIGHT = 16
+    OVERLAY_PADDING = 6
+    OVERLAY_ALPHA = 200
+    OVERLAY_BACKGROUND = Colors.black
+    OVERLAY_COLOR = Colors.white
+    OVERLAY_OVER_BUDGET_COLOR = Colors.red
+    # Text is only re-rendered this often so it stays readable and cheap
+    OVERLAY_REFRESH_FRAMES = 30
+
+    def __init__(self, history=HISTORY):
+        self.history = history
+        self._samples = numpy.zeros((len(self.PHASES), history))
+        self._rows = {phase: row for row, phase in enumerate(self.PHASES)}
+        self._current = numpy.zeros(len(self.PHASES))
+        self._frames = 0
+        self._last_frame_end = None
+        self._frame_times = numpy.zeros(history)
+        self.overlay_enabled = False
+        self._overlay = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of the with statement as part of the given phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[self._rows[name]] += time.perf_counter() - start
+
+    def end_frame(self):
+        """Push this frame's phase times into the ring buffers and start a new frame"""
+        now = time.perf_counter()
+        index = self._frames % self.history
+        self._samples[:, index] = self._current
+        self._current[:] = 0
+        if self._last_frame_end is not None:
+            self._frame_times[index] = now - self._last_frame_end
+        self._last_frame_end = now
+        self._frames += 1
+
+    def reset(self):
+        self._samples[:] = 0
+        self._current[:] = 0
+        self._frame_times[:] = 0
+        self._frames = 0
+        self._last_frame_end = None
+        self._overlay = None
+
+    def frame_count(self):
+        """Number of frames in the ring buffers"""
+        return min(self._frames, self.history)
+
+    def stats(self):
+        """Rolling milliseconds per frame of every phase and their total.
+        Returns {phase: {"p50": ms, "p95": ms, "p99": ms}}, empty before the first frame ends.
+        """
+        count = self.frame_count()
+        if not count:
+            return {}
+        millis = self._samples[:, :count] * 1000
+        rows = numpy.vstack((millis, millis.sum(axis=0)))
+        percentiles = numpy.percentile(rows, self.PERCENTILES, axis=1)
+        stats = {}
+        for row, phase in enumerate(self.PHASES + (self.TOTAL,)):
+            stats[phase] = {f"p{percentile}": float(percentiles[col, row])
+                            for col, percentile in enumerate(self.PERCENTILES)}
+        return stats
+
+    def fps(self):
+        """Frames per second over the ring buffers, wall clock time including the frame cap"""
+        count = self.frame_count()
+        elapsed = self._frame_times[:count].sum()
+        return count / elapsed if elapsed > 0 else 0.0
+
+    def toggle_overlay(self):
+        self.overlay_enabled = not self.overlay_enabled
+        self._overlay = None
+
+    def draw(self, renderer):
+        """Draw the stats table in the top right corner if the overlay is on"""
+        if not self.overlay_enabled:
+            return
+        if self._overlay is None or self._frames % self.OVERLAY_REFRESH_FRAMES == 0:
+            self._overlay = self._render_overlay()
+        if self._overlay is not None:
+            renderer.draw_surface(self._overlay, (renderer.window.get_width() - self._overlay.get_width(), 0))
+
+    def _render_overlay(self):
+        """Render the stats table to a translucent surface.
+        Phases whose p95 is over the frame budget are highlighted.
+        """
+        stats = self.stats()
+        if not stats:
+            return None
+        lines = [(f"{self.fps():5.1f} fps    p50    p95    p99", self.OVERLAY_COLOR)]
+        for phase in self.PHASES + (self.TOTAL,):
+            phase_stats = stats[phase]
+            color = self.OVERLAY_OVER_BUDGET_COLOR if phase_stats["p95"] > self.BUDGET_MS else self.OVERLAY_COLOR
+            lines.append((f"{phase:>16} " + " ".join(f"{phase_stats[f'p{percentile}']:6.2f}"
+                                                    for percentile in self.PERCENTILES), color))
+
+        font = ResourceManager.get_monospace_font(self.OVERLAY_TEXT_SIZE)
+        rendered = [font.render(text, True, color) for text, color in lines]
+        width = max(surf.get_width() for surf in rendered) + self.OVERLAY_PADDING * 2
+        height = len(rendered) * self.OVERLAY_LINE_HEIGHT + self.OVERLAY_PADDING * 2
+        overlay = pygame.Surface((width, height))
+        overlay.fill(self.OVERLAY_BACKGROUND)
+        overlay.set_alpha(self.OVERLAY_ALPHA)
+        for line, surf in enumerate(rendered):
+            overlay.blit(surf, (self.OVERLAY_PADDING, self.OVERLAY_PADDING + line * self.OVERLAY_LINE_HEIGHT))
+        return overlay
@@ -0,0 +1,122 @@
+"""
+Struct-of-arrays storage for everything in flight, like arrows
+"""
+import numpy
+from src.spatial import first_circle_hits
+
+
+class ProjectilePool:
+    """Holds every projectile in flight in contiguous arrays so they can be moved and checked for hits at once.
+    Each projectile owns a row until it hits something or flies out of range, then the row is reused.
+    """
+    INITIAL_CAPACITY = 256
+    VECTOR_FIELDS = ("pos", "prev_pos", "heading")
+    SCALAR_FIELDS = ("angle", "speed", "distance", "max_distance", "damage")
+    # Owner used for projectiles fired by someone without an army, they can hit anyone
+    NO_OWNER = -1
+    # Turn off to give every projectile a new row, for comparing allocations
+    REUSE_ROWS = True
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.capacity = capacity
+        self._next_row = 0
+        self._free_rows = []
+        # Every field is listed in VECTOR_FIELDS or SCALAR_FIELDS too, so it is grown
+        self.pos = numpy.zeros((capacity, 2))
+        self.prev_pos = numpy.zeros((capacity, 2))
+        self.heading = numpy.zeros((capacity, 2))
+        self.angle = numpy.zeros(capacity)
+        self.speed = numpy.zeros(capacity)
+        self.distance = numpy.zeros(capacity)
+        self.max_distance = numpy.zeros(capacity)
+        self.damage = numpy.zeros(capacity)
+        # Army id of whoever fired the projectile, it never hits that army
+        self.owner = numpy.full(capacity, self.NO_OWNER, dtype=numpy.intp)
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        # Rows handed out for the first time, and ones recycled from projectiles that are gone
+        self.created = 0
+        self.reused = 0
+
+    def __len__(self):
+        """Number of projectiles in flight"""
+        return int(numpy.count_nonzero(self.alive[:self._next_row]))
+
+    def fire(self, pos, angle, speed, max_distance, damage, owner=NO_OWNER):
+        """Launch a projectile from pos towards angle, returns its row"""
+        if self._free_rows:
+            row = self._free_rows.pop()
+            self.reused += 1
+        else:
+            if self._next_row == self.capacity:
+                self._grow()
+            row = self._next_row
+            self._next_row += 1
+            self.created += 1
+        radians = numpy.radians(angle)
+        self.pos[row] = pos[0], pos[1]
+        self.prev_pos[row] = pos[0], pos[1]
+        # Same as rotating (0, -1) by angle
+        self.heading[row] = numpy.sin(radians), -numpy.cos(radians)
+        self.angle[row] = angle
+        self.speed[row] = speed
+        self.distance[row] = 0
+        self.max_distance[row] = max_distance
+        self.damage[row] = damage
+        self.owner[row] = owner
+        self.alive[row] = True
+        return row
+
+    def live_rows(self):
+        return numpy.flatnonzero(self.alive[:self._next_row])
+
+    def kill(self, rows):
+        """Take projectiles out of flight and free their rows"""
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        self.alive[rows] = False
+        if self.REUSE_ROWS:
+            self._free_rows.extend(rows.tolist())
+
+    def clear(self):
+        """Take everything out of flight, the rows are kept for reuse"""
+        self.alive[:] = False
+        self._free_rows = list(range(self._next_row)) if self.REUSE_ROWS else []
+
+    def reset_counts(self):
+        self.created = 0
+        self.reused = 0
+
+    def _grow(self):
+        """Double the capacity of every array"""
+        new_capacity = self.capacity * 2
+        for name in self.VECTOR_FIELDS + self.SCALAR_FIELDS + ("owner", "alive"):
+            old = getattr(self, name)
+            new = numpy.zeros((new_capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.capacity] = old
+            setattr(self, name, new)
+        self.capacity = new_capacity
+
+    def update(self, delta):
+        """Move everything in flight one step.
+        Projectiles stop at their range, and fall out of flight the step after so their last stretch can still hit.
+        """
+        rows = self.live_rows()
+        spent = self.distance[rows] >= self.max_distance[rows]
+        self.kill(rows[spent])
+        rows = rows[~spent]
+        self.prev_pos[rows] = self.pos[rows]
+        dist = numpy.minimum(self.speed[rows] * delta, self.max_distance[rows] - self.distance[rows])
+        self.pos[rows] += self.heading[rows] * dist[:, numpy.newaxis]
+        self.distance[rows] += dist
+
+    def resolve_hits(self, positions, radii, owners):
+        """Check the path every projectile in flight took this step against circular targets.
+        Each projectile hits the first target of another army its path touches, and falls out of flight.
+        Testing the whole path means fast projectiles and big steps can't skip through a target.
+        Returns the rows of the projectiles that hit and the index of the target each one hit.
+        """
+        rows = self.live_rows()
+        paths, targets = first_circle_hits(self.prev_pos[rows], self.pos[rows], self.owner[rows],
+                                           positions, radii, owners)
+        hit_rows = rows[paths]
+        self.kill(hit_rows)
+        return hit_rows, targets
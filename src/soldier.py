@@ -2,11 +2,15 @@
 Class representing a soldier
 """
 import itertools
+import numpy
 import src.util as util
 from src.graphics import Colors
 from src.weapon import Sword, Bow
 from src.behavior import BehaviorTree
 from src.movable import Movable
+from src.army import Army
+from src.state import StateStore, scalar_property
+from src.pool import ObjectPool
 
 
 class Soldier(Movable):
@@ -16,6 +20,24 @@ class Soldier(Movable):
     DEFAULT_COLOR = Colors.white
     HEALING_FACTOR = 1.0
 
+    # Kinds of weapons, each animates and draws all of its own at once
+    WEAPON_CLASSES = (Sword, Bow)
+    # Army id kept in the store for soldiers without an army
+    NO_ARMY = -1
+
+    __slots__ = ("my_id", "_army", "formation", "behavior_tree", "weapon", "sight_range", "slot_costs",
+                 "flee_range", "influence")
+
+    # Soldiers get their own store so they can all be stepped together
+    _store = StateStore()
+    # Removed soldiers wait here to be placed again, with their weapon and behavior tree
+    _pool = ObjectPool()
+
+    health = scalar_property("health")
+    max_health = scalar_property("max_health")
+    radius = scalar_property("radius")
+    cleanup_timer = scalar_property("cleanup_timer")
+
     next_id = 1
 
     @classmethod
@@ -24,8 +46,45 @@ class Soldier(Movable):
         cls.next_id += 1
         return sid
 
+    @classmethod
+    def pool(cls):
+        """Gets the ObjectPool recycling removed soldiers"""
+        return cls._pool
+
     def __init__(self):
+        self.behavior_tree = None
+        self.weapon = None
         super(Soldier, self).__init__()
+
+    def __deepcopy__(self, memo):
+        clone = super(Soldier, self).__deepcopy__(memo)
+        # The weapon's state was copied along with the rest of the row
+        if clone.weapon:
+            clone.weapon.attach(clone.store(), clone.slot)
+        return clone
+
+    @property
+    def army(self):
+        return self._army
+
+    @army.setter
+    def army(self, army):
+        self._army = army
+        # The id is kept in the store too, for drawing and hit checks
+        self.store().army[self.slot] = army.my_id if army else self.NO_ARMY
+
+    def arm(self, weapon):
+        """Give the soldier a weapon, it keeps its state in the soldier's row of the store"""
+        weapon.attach(self.store(), self.slot)
+        weapon.reset()
+        self.weapon = weapon
+
+    def reset(self):
+        """Reset hook for the pool, the soldier comes back as new with a new id.
+        Its behavior tree and weapon are kept, the weapon is reset too. The tree is
+        made again if the engine or instrumentation changed since it was made.
+        """
+        super(Soldier, self).reset()
         self.my_id = Soldier.get_id()
         self.army = None
         self.formation = None
@@ -33,60 +92,157 @@ class Soldier(Movable):
         self.max_health = 0
         self.health = self.max_health
         self.cleanup_timer = Soldier.DEFAULT_CLEANUP_TIME
-        self.behavior_tree = None
-        self.weapon = None
         self.sight_range = 300
         self.slot_costs = (0, 0, 0)
         self.flee_range = 0
         self.influence = 1.0
+        if self.behavior_tree is not None and not self.behavior_tree.is_current():
+            self.behavior_tree = BehaviorTree(self.behavior_tree.tree_name)
+        if self.weapon:
+            self.weapon.reset()
 
     def set_position(self, x_pos, y_pos, facing=None):
         super(Soldier, self).set_position(x_pos, y_pos, facing)
-        self.weapon.wielder_update(self.pos, self.facing)
+        self.weapon.wielder_update(self.pos, self.facing, self.army)
 
     def set_position_vec(self, pos_vector):
         self.set_position(pos_vector.x, pos_vector.y)
 
-    def update(self, delta):
+    @classmethod
+    def update_all(cls, soldiers, delta):
+        """Update all of the given soldiers.
+        Every living soldier decides on its steering first, then they all move in one step.
+        """
+        soldiers = list(soldiers)
+        store = cls.store()
+        slots = numpy.fromiter((soldier.slot for soldier in soldiers), dtype=numpy.intp, count=len(soldiers))
+        cls.run_timers(slots[store.health[slots] > 0], delta)
+        batched = BehaviorTree.ENGINE == BehaviorTree.BATCHED
+        living = [soldier for soldier in soldiers if soldier.update(delta, think=not batched, timers=False)]
+        if batched:
+            BehaviorTree.run_batched(living, delta)
+        slots = numpy.fromiter((soldier.slot for soldier in living), dtype=numpy.intp, count=len(living))
+        store.handle_steering(delta, slots)
+        for soldier in living:
+            soldier.move_weapon()
+        kinds = store.weapon_kind[slots]
+        for weapon_class in cls.WEAPON_CLASSES:
+            weapon_class.update_all(store, slots[kinds == weapon_class.KIND], delta)
+
+    @classmethod
+    def run_timers(cls, slots, delta):
+        """Count down to moving again and heal, like update does, for the living soldiers in slots"""
+        store = cls.store()
+        store.stationary_timer[slots] -= delta
+        store.health[slots] = numpy.minimum(store.health[slots] + cls.HEALING_FACTOR * delta, store.max_health[slots])
+
+    def update(self, delta, think=True, timers=True):
+        """Run timers and behaviors, leaving the resulting steering to be applied.
+        Timers are skipped if timers is False and behaviors if think is False,
+        so they can be run for many soldiers at once.
+        Returns True iff the soldier is alive and needs to move.
+        """
         # Countdown to removal if needed
         if not self.is_alive():
             self.cleanup_timer -= delta
             if self.weapon:
                 self.weapon.deactivate()
-            return
+            return False
 
-        # countdown to being able to move again
-        self.stationary_timer -= delta
+        if timers:
+            # countdown to being able to move again
+            self.stationary_timer -= delta
 
-        # Slow healing over time
-        self.heal(Soldier.HEALING_FACTOR * delta)
+            # Slow healing over time
+            self.heal(Soldier.HEALING_FACTOR * delta)
 
         self.reset_steering()
-        self.behavior_tree.run(self, delta)
-        self.handle_steering(delta)
+        if think:
+            self.behavior_tree.run(self, delta)
+        return True
 
+    def move_weapon(self):
+        """Bring the weapon along after the soldier has moved"""
         if self.weapon:
-            self.weapon.wielder_update(self.pos, self.facing)
-            self.weapon.update(delta)
-
-    def interact(self, other):
-        """Check interactions with another soldier"""
-        if not other.is_alive():
-            return
-        if self.weapon:
-            # Are we hitting them with our weapon?
-            if self.army is not other.army and self.weapon.hits_circle(other.pos, other.radius):
-                other.take_damage(self.weapon.damage)
-                self.weapon.deactivate()
+            self.weapon.wielder_update(self.pos, self.facing, self.army)
 
     def draw(self, renderer):
+        sprites = []
+        self.add_sprites(sprites, renderer.atlas, renderer.interpolation)
+        renderer.draw_sprites(sprites)
+
+    def add_sprites(self, sprites, atlas, interpolation):
+        """Add the (surface, top_left) pairs that draw this soldier and its weapon.
+        Lets every soldier be drawn with one blits call.
+        """
+        pos = self.render_pos(interpolation)
         health_factor = (self.health + 30.0) / (self.max_health + 30)
         color = self.army.color if self.army else self.DEFAULT_COLOR
-        current_color = [max(int(part * health_factor), 0) for part in color]
-        renderer.draw_circle(current_color, self.pos, self.radius)
-        renderer.draw_circle(Colors.black, self.pos, self.radius, 1)
+        surf, offset = atlas.body(color, health_factor, int(self.radius))
+        sprites.append((surf, (int(pos.x) + offset[0], int(pos.y) + offset[1])))
+
+        self.weapon.add_sprites(sprites, atlas, pos, self.render_facing(interpolation), interpolation)
 
-        self.weapon.draw(renderer)
+    @classmethod
+    def add_all_sprites(cls, slots, sprites, atlas, interpolation):
+        """Add the sprites of the soldiers in slots of the store, like add_sprites for each of them.
+        Everything is read from the store and looked up in the atlas's sprite tables with numpy,
+        the only per soldier Python work left is making the list of sprites.
+        """
+        count = len(slots)
+        if not count:
+            return
+        store = cls.store()
+        prev_pos = store.prev_pos[slots]
+        points = (prev_pos + (store.pos[slots] - prev_pos) * interpolation).astype(numpy.intp)
+        prev_facing = store.prev_facing[slots]
+        facings = prev_facing + cls._normalize_rotations(store.facing[slots] - prev_facing) * interpolation
+        facings = cls._normalize_rotations(facings)
+
+        # Bodies, numbered by radius, army color and health
+        health_factors = (store.health[slots] + 30.0) / (store.max_health[slots] + 30)
+        health_buckets = numpy.clip(numpy.rint(health_factors * atlas.HEALTH_BUCKETS), 0,
+                                    atlas.HEALTH_BUCKETS).astype(numpy.intp)
+        # Color 0 is for soldiers without an army
+        colors = [cls.DEFAULT_COLOR] + Army.COLORS
+        color_codes = store.army[slots].astype(numpy.intp) + 1
+        radii = store.radius[slots].astype(numpy.intp)
+
+        def render_body(code):
+            look, health_bucket = divmod(code, atlas.HEALTH_BUCKETS + 1)
+            radius, color = divmod(look, len(colors))
+            return atlas.body(colors[color], health_bucket / atlas.HEALTH_BUCKETS, radius)
+
+        codes = (radii * len(colors) + color_codes) * (atlas.HEALTH_BUCKETS + 1) + health_buckets
+        body_surfaces, body_offsets = atlas.table("body", render_body).lookup(codes)
+
+        # Weapons, each kind does all of its own at once
+        surfaces = numpy.empty((count, 2), dtype=object)
+        surfaces[:, 0] = body_surfaces
+        top_lefts = numpy.empty((count, 2, 2), dtype=numpy.intp)
+        top_lefts[:, 0] = points + body_offsets
+        kinds = store.weapon_kind[slots]
+        for weapon_class in cls.WEAPON_CLASSES:
+            rows = numpy.flatnonzero(kinds == weapon_class.KIND)
+            if len(rows):
+                surfaces[rows, 1], top_lefts[rows, 1] = weapon_class.batch_sprites(
+                    store, slots[rows], points[rows], facings[rows], atlas)
+
+        # Each soldier's weapon is drawn right after its body
+        surfaces = surfaces.reshape(-1)
+        top_lefts = top_lefts.reshape(-1, 2)
+        if not kinds.all():
+            has_sprite = numpy.not_equal(surfaces, None)
+            surfaces, top_lefts = surfaces[has_sprite], top_lefts[has_sprite]
+        sprites.extend(zip(surfaces.tolist(), top_lefts.tolist()))
+
+    @staticmethod
+    def _normalize_rotations(rotations):
+        """Vectorized util.normalize_rotation"""
+        rotations = rotations.copy()
+        rotations[rotations > 180] -= 360
+        rotations[rotations <= -180] += 360
+        return rotations
 
     def heal(self, amount):
         self.health += amount
@@ -96,6 +252,14 @@ class Soldier(Movable):
     def take_damage(self, damage):
         self.health = max(self.health - damage, 0)
 
+    @classmethod
+    def take_damage_all(cls, slots, damages):
+        """Like take_damage for the soldiers in slots, a slot can be hit more than once"""
+        store = cls.store()
+        numpy.subtract.at(store.health, slots, damages)
+        hit = numpy.unique(slots)
+        store.health[hit] = numpy.maximum(store.health[hit], 0)
+
     def overlaps(self, x_pos, y_pos):
         dist = util.distance(self.pos.x, self.pos.y, x_pos, y_pos)
         return dist <= self.radius
@@ -129,26 +293,36 @@ class Soldier(Movable):
 
 
 class Swordsperson(Soldier):
+    __slots__ = ()
+
     def __init__(self):
         super(Swordsperson, self).__init__()
+        self.behavior_tree = BehaviorTree("swordsman")
+        self.arm(Sword())
+
+    def reset(self):
+        super(Swordsperson, self).reset()
         self.max_velocity = 80
         self.max_rotation = 300
         self.max_health = 120
         self.health = self.max_health
-        self.behavior_tree = BehaviorTree("swordsman")
-        self.weapon = Sword()
         self.slot_costs = (10, 0, 100)
 
 
 class Archer(Soldier):
+    __slots__ = ()
+
     def __init__(self):
         super(Archer, self).__init__()
+        self.behavior_tree = BehaviorTree("archer")
+        self.arm(Bow())
+
+    def reset(self):
+        super(Archer, self).reset()
         self.max_velocity = 80
         self.max_rotation = 300
         self.max_health = 60
         self.health = self.max_health
-        self.behavior_tree = BehaviorTree("archer")
-        self.weapon = Bow()
         self.slot_costs = (10, 100, 0)
         self.flee_range = 100
         self.influence = 0.75
@@ -0,0 +1,169 @@
+"""
+Spatial indexes used to avoid checking every pair of soldiers
+"""
+import numpy
+from scipy.spatial import cKDTree
+from pygame import Vector2
+
+
+def first_circle_hits(starts, ends, owners, positions, radii, target_owners):
+    """Find the first circular target of another owner that each path from start to end touches.
+    Paths can have zero length, then the closest target they are inside is hit.
+    Candidates come from one KD-tree query between the middles of the paths and the targets.
+    Returns the index of every path that hit something and the index of the target it hit.
+    """
+    none = numpy.zeros(0, dtype=numpy.intp)
+    if not len(starts) or not len(positions):
+        return none, none
+    moves = ends - starts
+    lengths_sq = (moves ** 2).sum(axis=1)
+
+    # Candidates are targets close enough to the middle of a path that it could touch them
+    reach = numpy.nextafter(numpy.sqrt(lengths_sq.max()) / 2 + radii.max(), numpy.inf)
+    pairs = cKDTree(starts + moves / 2).sparse_distance_matrix(cKDTree(positions), reach, output_type="ndarray")
+    paths, targets = pairs["i"].astype(numpy.intp), pairs["j"].astype(numpy.intp)
+    enemies = target_owners[targets] != owners[paths]
+    paths, targets = paths[enemies], targets[enemies]
+
+    # Closest point of each path to each candidate, as a fraction of the way along it
+    offsets = positions[targets] - starts[paths]
+    path_moves = moves[paths]
+    path_lengths_sq = lengths_sq[paths]
+    still = path_lengths_sq == 0
+    path_lengths_sq = numpy.where(still, 1, path_lengths_sq)
+    along = numpy.einsum("ij,ij->i", offsets, path_moves) / path_lengths_sq
+    closest = offsets - path_moves * numpy.clip(along, 0, 1)[:, numpy.newaxis]
+    radii_sq = radii[targets] ** 2
+    touching = (closest ** 2).sum(axis=1) <= radii_sq
+    if not touching.any():
+        return none, none
+    paths, targets, along, still = paths[touching], targets[touching], along[touching], still[touching]
+
+    # Where each path first enters the circle, the earliest one along the path is hit, then the closest
+    miss_sq = numpy.maximum((offsets[touching] ** 2).sum(axis=1) - along ** 2 * path_lengths_sq[touching], 0)
+    inside = numpy.sqrt((radii_sq[touching] - miss_sq) / path_lengths_sq[touching])
+    entry = numpy.where(still, 0, numpy.maximum(along - inside, 0))
+    order = numpy.lexsort((miss_sq, entry, paths))
+    paths, targets = paths[order], targets[order]
+    first = numpy.ones(len(paths), dtype=bool)
+    first[1:] = paths[1:] != paths[:-1]
+    return paths[first], targets[first]
+
+
+class SoldierIndex:
+    """Snapshot of the living soldiers taken once per frame.
+    Answers neighbor queries for all soldiers in batches, each batch is only computed
+    the first time a behavior asks for it.
+    """
+    def __init__(self, soldiers):
+        self.soldiers = [soldier for soldier in soldiers if soldier.is_alive()]
+        self._rows = {soldier.my_id: row for row, soldier in enumerate(self.soldiers)}
+        self.store = self.soldiers[0].store() if self.soldiers else None
+        self.slots = numpy.fromiter((soldier.slot for soldier in self.soldiers), dtype=numpy.intp,
+                                    count=len(self.soldiers))
+        self.positions = self.store.pos[self.slots] if self.soldiers else numpy.zeros((0, 2))
+        self._tree = None
+        self._army_rows = None
+        self._army_trees = None
+        self._nearest_enemies = None
+        self._separations = {}
+
+    def tree(self):
+        """KD-tree over every living soldier"""
+        if self._tree is None:
+            self._tree = cKDTree(self.positions)
+        return self._tree
+
+    def _build_army_trees(self):
+        """Group the soldiers by army and build a KD-tree for each army"""
+        groups = {}
+        for row, soldier in enumerate(self.soldiers):
+            groups.setdefault(soldier.army, []).append(row)
+        self._army_rows = {army: numpy.array(rows, dtype=numpy.intp) for army, rows in groups.items()}
+        self._army_trees = {army: cKDTree(self.positions[rows])
+                            for army, rows in self._army_rows.items()}
+
+    def _find_nearest_enemies(self):
+        """Find the closest enemy within sight range of every soldier with one query per army pair.
+        Returns the row of each soldier's enemy, or -1 if there is none.
+        """
+        if self._army_trees is None:
+            self._build_army_trees()
+        nearest = numpy.full(len(self.soldiers), -1, dtype=numpy.intp)
+        for army, rows in self._army_rows.items():
+            sight = numpy.array([self.soldiers[row].sight_range for row in rows], dtype=float)
+            positions = self.positions[rows]
+            best_dist = numpy.full(len(rows), numpy.inf)
+            best_enemy = numpy.full(len(rows), -1, dtype=numpy.intp)
+            for enemy_army, enemy_tree in self._army_trees.items():
+                if enemy_army is army:
+                    # Same team
+                    continue
+                dist, found = enemy_tree.query(positions, k=1,
+                                               distance_upper_bound=numpy.nextafter(sight.max(), numpy.inf))
+                closer = (dist <= sight) & (dist <= best_dist)
+                best_dist[closer] = dist[closer]
+                best_enemy[closer] = self._army_rows[enemy_army][found[closer]]
+            nearest[rows] = best_enemy
+        return nearest
+
+    def rows_for(self, soldiers):
+        """Row of each of the given living soldiers in this index"""
+        return numpy.fromiter((self._rows[soldier.my_id] for soldier in soldiers), dtype=numpy.intp,
+                              count=len(soldiers))
+
+    def nearest_enemy_rows(self):
+        """Row of the closest enemy within sight range of every soldier, -1 if there is none"""
+        if self._nearest_enemies is None:
+            self._nearest_enemies = self._find_nearest_enemies()
+        return self._nearest_enemies
+
+    def nearest_enemy(self, soldier):
+        """The closest living enemy within the soldier's sight range, or None"""
+        row = self._rows.get(soldier.my_id, None)
+        if row is None:
+            return None
+        enemy_row = self.nearest_enemy_rows()[row]
+        return self.soldiers[enemy_row] if enemy_row >= 0 else None
+
+    def _find_separations(self, spread_dist):
+        """Sum up the push away from every neighbor closer than spread_dist for all soldiers.
+        Each push is scaled by the soldier's max velocity and clamped to its max acceleration,
+        just like adding them one at a time with Movable.add_velocity_steering.
+        """
+        separations = numpy.zeros_like(self.positions)
+        if len(self.soldiers) < 2:
+            return separations
+        pairs = self.tree().query_pairs(spread_dist, output_type="ndarray")
+        if not len(pairs):
+            return separations
+        firsts, seconds = pairs[:, 0], pairs[:, 1]
+        displacement = self.positions[firsts] - self.positions[seconds]
+        dist = numpy.hypot(displacement[:, 0], displacement[:, 1])
+        # query_pairs includes pairs at exactly spread_dist
+        close = dist < spread_dist
+        firsts, seconds, displacement = firsts[close], seconds[close], displacement[close]
+        max_velocity = self.store.max_velocity[self.slots]
+        max_accel = self.store.max_vel_accel[self.slots]
+        for rows, push in ((firsts, displacement), (seconds, -displacement)):
+            steering = push * max_velocity[rows, numpy.newaxis]
+            length = numpy.hypot(steering[:, 0], steering[:, 1])
+            too_long = length > max_accel[rows]
+            steering[too_long] *= (max_accel[rows][too_long] / length[too_long])[:, numpy.newaxis]
+            numpy.add.at(separations, rows, steering)
+        return separations
+
+    def separations(self, spread_dist):
+        """Separation steering of every soldier for the given spread distance"""
+        separations = self._separations.get(spread_dist, None)
+        if separations is None:
+            separations = self._find_separations(spread_dist)
+            self._separations[spread_dist] = separations
+        return separations
+
+    def separation(self, soldier, spread_dist):
+        """Velocity steering pushing the soldier away from neighbors closer than spread_dist"""
+        row = self._rows.get(soldier.my_id, None)
+        if row is None:
+            return Vector2()
+        return Vector2(*self.separations(spread_dist)[row].tolist())
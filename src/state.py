@@ -0,0 +1,181 @@
+"""
+Central struct-of-arrays storage for the state of things that move
+"""
+import numpy
+from pygame import Vector2
+
+
+def vector_property(name):
+    """Property that reads and writes one row of a 2D array in the owner's StateStore.
+    The owner has a store() and the slot of its row.
+    Reading gives a copy, so changing it in place, like owner.pos.x = 1, leaves the store alone.
+    Assign a whole vector instead, owner.pos = (1, owner.pos.y).
+    """
+    def getter(self):
+        return Vector2(*getattr(self.store(), name)[self.slot].tolist())
+
+    def setter(self, value):
+        row = getattr(self.store(), name)[self.slot]
+        row[0] = value[0]
+        row[1] = value[1]
+
+    return property(getter, setter)
+
+
+def scalar_property(name):
+    """Property that reads and writes one element of an array in the owner's StateStore.
+    The owner has a store() and the slot of its row.
+    """
+    def getter(self):
+        return getattr(self.store(), name).item(self.slot)
+
+    def setter(self, value):
+        getattr(self.store(), name)[self.slot] = value
+
+    return property(getter, setter)
+
+
+class StateStore:
+    """Holds the state of many Movables in contiguous arrays.
+    Each Movable owns one row (its slot) of every array.
+    """
+    INITIAL_CAPACITY = 64
+    VECTOR_FIELDS = ("pos", "prev_pos", "velocity", "velocity_steering")
+    SCALAR_FIELDS = ("facing", "prev_facing", "rotation", "rotation_steering", "max_velocity",
+                     "max_vel_accel", "max_rotation", "max_rot_accel", "stationary_timer", "health",
+                     "cleanup_timer", "max_health", "radius", "army", "weapon_kind", "weapon_timer",
+                     "weapon_dist", "weapon_angle")
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.capacity = capacity
+        self._next_slot = 0
+        self._free_slots = []
+        # Every field is listed in VECTOR_FIELDS or SCALAR_FIELDS too, so it is copied and grown
+        self.pos = numpy.zeros((capacity, 2))
+        self.prev_pos = numpy.zeros((capacity, 2))
+        self.velocity = numpy.zeros((capacity, 2))
+        self.velocity_steering = numpy.zeros((capacity, 2))
+        self.facing = numpy.zeros(capacity)
+        self.prev_facing = numpy.zeros(capacity)
+        self.rotation = numpy.zeros(capacity)
+        self.rotation_steering = numpy.zeros(capacity)
+        self.max_velocity = numpy.zeros(capacity)
+        self.max_vel_accel = numpy.zeros(capacity)
+        self.max_rotation = numpy.zeros(capacity)
+        self.max_rot_accel = numpy.zeros(capacity)
+        self.stationary_timer = numpy.zeros(capacity)
+        self.health = numpy.zeros(capacity)
+        self.cleanup_timer = numpy.zeros(capacity)
+        self.max_health = numpy.zeros(capacity)
+        self.radius = numpy.zeros(capacity)
+        # Id of the army, and the kind of weapon wielded and its state, so soldiers are drawn without visiting each
+        self.army = numpy.zeros(capacity)
+        self.weapon_kind = numpy.zeros(capacity)
+        self.weapon_timer = numpy.zeros(capacity)
+        self.weapon_dist = numpy.zeros(capacity)
+        self.weapon_angle = numpy.zeros(capacity)
+
+    def __len__(self):
+        """Number of slots currently in use"""
+        return self._next_slot - len(self._free_slots)
+
+    def allocate(self):
+        """Reserve a zeroed slot and return its index"""
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self._next_slot == self.capacity:
+                self._grow()
+            slot = self._next_slot
+            self._next_slot += 1
+        self.clear_slot(slot)
+        return slot
+
+    def clear_slot(self, slot):
+        """Zero every field of a slot"""
+        for name in self.VECTOR_FIELDS + self.SCALAR_FIELDS:
+            getattr(self, name)[slot] = 0
+
+    def release(self, slot):
+        """Return a slot so it can be handed out again"""
+        self._free_slots.append(slot)
+
+    def copy_slot(self, src_slot, dst_slot):
+        for name in self.VECTOR_FIELDS + self.SCALAR_FIELDS:
+            field = getattr(self, name)
+            field[dst_slot] = field[src_slot]
+
+    def _grow(self):
+        """Double the capacity of every array"""
+        new_capacity = self.capacity * 2
+        for name in self.VECTOR_FIELDS + self.SCALAR_FIELDS:
+            old = getattr(self, name)
+            new = numpy.zeros((new_capacity,) + old.shape[1:])
+            new[:self.capacity] = old
+            setattr(self, name, new)
+        self.capacity = new_capacity
+
+    def save_previous_state(self):
+        """Remember where everything is before a simulation tick so drawing can interpolate"""
+        self.prev_pos[:] = self.pos
+        self.prev_facing[:] = self.facing
+
+    def reset_steering(self, slots):
+        self.velocity_steering[slots] = 0
+        self.rotation_steering[slots] = 0
+
+    def handle_steering(self, delta, slots):
+        """Apply the current steering values to move every Movable in slots at once"""
+        slots = numpy.asarray(slots, dtype=numpy.intp)
+
+        # Velocity
+        # Don't move if we are temporarily stationary
+        moving = slots[self.stationary_timer[slots] <= 0]
+        steering = self.velocity_steering[moving]
+        self._clamp_length(steering, self.max_vel_accel[moving])
+        self.velocity_steering[moving] = steering
+        velocity = self.velocity[moving] + steering
+        self._clamp_length(velocity, self.max_velocity[moving])
+        self.velocity[moving] = velocity
+        self.pos[moving] += velocity * delta
+
+        # Rotation
+        rotation_steering = numpy.minimum(self.rotation_steering[slots], self.max_rot_accel[slots])
+        self.rotation_steering[slots] = rotation_steering
+        rotation = self.rotation[slots] + rotation_steering
+        max_rotation = self.max_rotation[slots]
+        rotation = numpy.where(numpy.abs(rotation) > max_rotation,
+                               numpy.copysign(max_rotation, rotation), rotation)
+        self.rotation[slots] = rotation
+        facing = self.facing[slots] + rotation * delta
+        facing[facing > 180] -= 360
+        facing[facing <= -180] += 360
+        self.facing[slots] = facing
+
+    def add_velocity_steering(self, slots, steering):
+        """Clamp each steering vector to its max acceleration and add it to the slot's steering"""
+        self._clamp_length(steering, self.max_vel_accel[slots])
+        self.velocity_steering[slots] += steering
+
+    def add_rotation_steering(self, slots, steering):
+        """Vectorized Movable.add_rotation_steering"""
+        self.rotation[slots] += numpy.minimum(steering, self.max_rot_accel[slots])
+
+    def rotation_to_dest(self, slots, destinations):
+        """Angle in degrees from each slot's facing to its destination"""
+        direction = destinations - self.pos[slots]
+        facing = numpy.radians(self.facing[slots])
+        # Facing direction is (0, -1) rotated by the facing angle
+        rotation = numpy.degrees(numpy.arctan2(direction[:, 1], direction[:, 0]) -
+                                 numpy.arctan2(-numpy.cos(facing), numpy.sin(facing)))
+        rotation[rotation > 180] -= 360
+        rotation[rotation <= -180] += 360
+        return rotation
+
+    @staticmethod
+    def _clamp_length(vectors, max_lengths):
+        """Scale down, in place, any vectors longer than their max length"""
+        lengths = numpy.hypot(vectors[:, 0], vectors[:, 1])
+        too_long = lengths > max_lengths
+        if too_long.any():
+            vectors[too_long] *= (max_lengths[too_long] / lengths[too_long])[:, numpy.newaxis]
@@ -31,14 +31,18 @@ def vec_to_ints(vec):
 
 class FrameTimer:
     """
-    Keeps track of and controls frame rate
+    Keeps track of and controls frame rate.
+    Also splits frame time into fixed length simulation ticks.
     """
     DEFAULT_FRAMERATE = 60
+    DEFAULT_SIM_RATE = 60
     MAX_FRAME_TIME = 1.0 / 10
 
-    def __init__(self):
+    def __init__(self, sim_rate=DEFAULT_SIM_RATE):
         self.framerate = FrameTimer.DEFAULT_FRAMERATE
         self.clock = pygame.time.Clock()
+        self.sim_step = 1.0 / sim_rate
+        self._accumulator = 0.0
 
     def next_frame(self):
         """Call once per frame to limit fps and compute delta"""
@@ -53,5 +57,13 @@ class FrameTimer:
 
         return delta
 
-    def print_fps(self):
-        print(self.clock.get_fps())
+    def sim_ticks(self, delta):
+        """Add the frame time and return how many fixed simulation ticks are now due"""
+        self._accumulator += delta
+        ticks = int(self._accumulator // self.sim_step)
+        self._accumulator -= ticks * self.sim_step
+        return ticks
+
+    def interpolation(self):
+        """How far the leftover frame time is into the next simulation tick, 0 to 1"""
+        return self._accumulator / self.sim_step
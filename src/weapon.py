@@ -1,32 +1,92 @@
 """
 Classes representing weapons like a sword or bow
 """
+import copy
 import math
-from pygame import Vector2, Rect
+import numpy
+from pygame import Vector2
 from src.graphics import Colors
+from src.projectile import ProjectilePool
+from src.state import scalar_property
 
 
 class Weapon:
-    """Abstract base class for weapons usable by soldiers"""
+    """Abstract base class for weapons usable by soldiers.
+    What changes as a weapon is used lives in its wielder's row of the wielder's StateStore,
+    so every weapon of a kind can be animated and drawn at once.
+    """
+    # Kind of weapon kept in the wielder's row, 0 is none
+    KIND = 0
+
+    __slots__ = ("pos", "angle", "army", "damage", "stationary_time", "_store", "_slot")
+
     def __init__(self):
         # Position of the weapon wielder
         self.pos = Vector2()
         # Angle relative to wielder
         self.angle = 0
+        # Army of the wielder
+        self.army = None
         self.damage = 0
         self.stationary_time = 0
+        self._store = None
+        self._slot = None
+
+    def store(self):
+        """Gets the StateStore of the wielder"""
+        return self._store
+
+    @property
+    def slot(self):
+        """Row of the wielder in its store"""
+        return self._slot
+
+    def attach(self, store, slot):
+        """Keep the weapon's state in the given row of a wielder's store"""
+        self._store = store
+        self._slot = slot
+
+    def reset(self):
+        """Put back anything that changes while the weapon is used, for when its wielder is recycled"""
+        self.pos.x = 0
+        self.pos.y = 0
+        self.angle = 0
+        self.army = None
+        self._store.weapon_kind[self._slot] = self.KIND
+
+    def __deepcopy__(self, memo):
+        """Copy everything but the wielder's store, the copy is attached to its own wielder"""
+        clone = self.__class__.__new__(self.__class__)
+        memo[id(self)] = clone
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if name not in ("_store", "_slot") and hasattr(self, name):
+                    setattr(clone, name, copy.deepcopy(getattr(self, name), memo))
+        clone._store = None
+        clone._slot = None
+        return clone
+
+    @classmethod
+    def update_all(cls, store, slots, delta):
+        """Update the weapons of this class wielded from the given slots of store"""
+
+    def add_sprites(self, sprites, atlas, pos, angle, interpolation):
+        """Add (surface, top_left) pairs that draw the weapon as if wielded at pos, facing angle"""
+        raise NotImplementedError()
 
-    def update(self, delta):
-        pass
-
-    def draw(self, renderer):
+    @classmethod
+    def batch_sprites(cls, store, slots, points, angles, atlas):
+        """Sprites for the weapons of this class wielded from slots of store, at integer points facing angles.
+        Returns an object array with a surface per weapon and an (n, 2) array of top lefts.
+        """
         raise NotImplementedError()
 
-    def wielder_update(self, pos, facing):
+    def wielder_update(self, pos, facing, army=None):
         """Update the position of the weapon based on the passed in position"""
         self.pos.x = pos.x
         self.pos.y = pos.y
         self.angle = facing
+        self.army = army
 
     def activate(self):
         pass
@@ -34,12 +94,10 @@ class Weapon:
     def deactivate(self):
         pass
 
-    def hits_circle(self, other_pos, other_radius):
-        raise NotImplementedError()
-
 
 class Sword(Weapon):
     """Melee weapon - sword"""
+    KIND = 1
     INACTIVE = -1.0
     START = 0.0
     FINISHED = 0.75
@@ -47,52 +105,69 @@ class Sword(Weapon):
     START_DIST_OFFSET = 4
     FINAL_DIST_OFFSET = 8
     START_ANGLE_OFFSET = 0
+    POS_SPEED = 600
+    ANGLE_SPEED = 500
+    LENGTH = 22
+    WIDTH = 5
+    DAMAGE = 30
     COLOR = Colors.darkgrey
 
+    __slots__ = ("attack_range",)
+
+    swing_time = scalar_property("weapon_timer")
+    # Offset from wielder
+    dist_offset = scalar_property("weapon_dist")
+    angle_offset = scalar_property("weapon_angle")
+
     def __init__(self):
         super(Sword, self).__init__()
-        self.pos_speed = 600
-        self.angle_speed = 500
-        self.damage = 30
-        self.swing_time = self.INACTIVE
-        self.length = 22
-        self.width = 5
-        self.attack_range = self.length + self.FINAL_DIST_OFFSET
+        self.damage = self.DAMAGE
+        self.attack_range = self.LENGTH + self.FINAL_DIST_OFFSET
         self.stationary_time = 0.1
 
-        # Offset from wielder
+    def reset(self):
+        super(Sword, self).reset()
+        self.swing_time = self.INACTIVE
         self.dist_offset = self.START_DIST_OFFSET
         self.angle_offset = self.START_ANGLE_OFFSET
 
-    def update(self, delta):
-        self.animate(delta)
-
-    def animate(self, delta):
-        """Swing the sword"""
-        if self.swing_time > self.FINISHED:
-            self.swing_time = self.INACTIVE
-
-        if self.swing_time < self.START:
+    @classmethod
+    def update_all(cls, store, slots, delta):
+        """Swing every sword that was activated, and sheathe the rest again"""
+        swing_time = store.weapon_timer[slots]
+        swing_time[swing_time > cls.FINISHED] = cls.INACTIVE
+        swinging = swing_time >= cls.START
+        dist_offset = store.weapon_dist[slots]
+        angle_offset = store.weapon_angle[slots]
+        # Progress through swing
+        swing_time[swinging] += delta
+        store.weapon_timer[slots] = swing_time
+        store.weapon_dist[slots] = numpy.where(
+            swinging, numpy.minimum(dist_offset + cls.POS_SPEED * delta, cls.FINAL_DIST_OFFSET),
             # Return to sheathed position
-            if self.dist_offset > self.START_DIST_OFFSET:
-                change = self.pos_speed * delta
-                self.dist_offset = max(self.dist_offset - change, self.START_DIST_OFFSET)
-            if self.angle_offset > self.START_ANGLE_OFFSET:
-                change = self.angle_speed * delta
-                self.angle_offset = max(self.angle_offset - change, self.START_ANGLE_OFFSET)
-        else:
-            # Progress through swing
-            self.swing_time += delta
-            change = self.pos_speed * delta
-            self.dist_offset = min(self.dist_offset + change, self.FINAL_DIST_OFFSET)
-            self.angle_offset += self.angle_speed * delta
-
-    def draw(self, renderer):
-        norm = Vector2(0, -1)
-        norm.rotate_ip(self.angle + self.angle_offset)
-        start_pos = self.pos + norm * self.dist_offset
-        end_pos = self.pos + norm * (self.dist_offset + self.length)
-        renderer.draw_line(self.COLOR, start_pos, end_pos, self.width)
+            numpy.maximum(dist_offset - cls.POS_SPEED * delta, cls.START_DIST_OFFSET))
+        store.weapon_angle[slots] = numpy.where(
+            swinging, angle_offset + cls.ANGLE_SPEED * delta,
+            numpy.maximum(angle_offset - cls.ANGLE_SPEED * delta, cls.START_ANGLE_OFFSET))
+
+    def add_sprites(self, sprites, atlas, pos, angle, interpolation):
+        dist_offset = int(round(self.dist_offset))
+        surf, offset = atlas.line(self.COLOR, angle + self.angle_offset, dist_offset,
+                                  dist_offset + self.LENGTH, self.WIDTH)
+        sprites.append((surf, (int(pos.x) + offset[0], int(pos.y) + offset[1])))
+
+    @classmethod
+    def batch_sprites(cls, store, slots, points, angles, atlas):
+        dist_offsets = numpy.rint(store.weapon_dist[slots]).astype(numpy.intp)
+        buckets = atlas.angle_buckets(angles + store.weapon_angle[slots])
+
+        def render(code):
+            dist_offset, bucket = divmod(code, atlas.ANGLE_BUCKETS)
+            return atlas.line(cls.COLOR, atlas.bucket_angle(bucket), dist_offset, dist_offset + cls.LENGTH,
+                              cls.WIDTH)
+
+        surfaces, offsets = atlas.table("sword", render).lookup(dist_offsets * atlas.ANGLE_BUCKETS + buckets)
+        return surfaces, points + offsets
 
     def activate(self):
         """Start a swing"""
@@ -103,115 +178,112 @@ class Sword(Weapon):
         """Cancel a swing"""
         self.swing_time = self.INACTIVE
 
-    def hits_circle(self, other_pos, other_radius):
-        if self.swing_time == self.INACTIVE:
-            return False
-        norm = Vector2(0, -1)
-        norm.rotate_ip(self.angle + self.angle_offset)
-        end_pos = self.pos + norm * (self.dist_offset + self.length)
-        dist = other_pos.distance_to(end_pos)
-        return dist <= other_radius
+    @classmethod
+    def swinging_all(cls, store, slots):
+        """Which of the given slots of store wield a sword that is being swung"""
+        return (store.weapon_kind[slots] == cls.KIND) & (store.weapon_timer[slots] != cls.INACTIVE)
+
+    @classmethod
+    def deactivate_all(cls, store, slots):
+        """Cancel the swings of the swords wielded from slots"""
+        store.weapon_timer[slots] = cls.INACTIVE
+
+    @classmethod
+    def tips(cls, store, slots):
+        """(n, 2) array of where the tip of each sword wielded from slots is, the only part of a swing that hits"""
+        angles = numpy.radians(store.facing[slots] + store.weapon_angle[slots])
+        reach = store.weapon_dist[slots] + cls.LENGTH
+        pos = store.pos[slots]
+        # Same as rotating (0, -1) by the angle
+        return numpy.column_stack((pos[:, 0] + numpy.sin(angles) * reach, pos[:, 1] - numpy.cos(angles) * reach))
 
 
 class Bow(Weapon):
     """Ranged weapon - Bow"""
+    KIND = 2
     COLOR = [max(part - 90, 0) for part in Colors.brown]
     FIRING_SPEED = 2.0
     SIZE = 25
     CURVE = math.pi * .4
-    ANGLE_FIX = math.pi * 0.5
+    # Offset from wielder
+    DIST_OFFSET = 6
+
+    __slots__ = ("attack_range",)
+
+    fire_timer = scalar_property("weapon_timer")
 
     def __init__(self):
         super(Bow, self).__init__()
-        self.arrows = []
         self.damage = 20
         self.attack_range = 400
-        self.fire_timer = 0
         self.stationary_time = 0.2
 
-        # Offset from wielder
-        self.dist_offset = 6
-        self.angle_offset = 0
-
-    def update(self, delta):
-        self.fire_timer -= delta
+    def reset(self):
+        super(Bow, self).reset()
+        self.fire_timer = 0
 
-        for arrow in self.arrows:
-            arrow.update(delta)
+    @classmethod
+    def update_all(cls, store, slots, delta):
+        store.weapon_timer[slots] -= delta
 
-        # Remove spent arrows
-        self.arrows = [arrow for arrow in self.arrows if not arrow.needs_removal()]
+    def add_sprites(self, sprites, atlas, pos, angle, interpolation):
+        surf, offset = atlas.arc(self.COLOR, angle, self.DIST_OFFSET, self.SIZE, self.CURVE, 3)
+        sprites.append((surf, (int(pos.x) + offset[0], int(pos.y) + offset[1])))
 
-    def draw(self, renderer):
-        norm = Vector2(0, -1)
-        norm.rotate_ip(self.angle)
-        pos = self.pos + norm * self.dist_offset
-        rect = Rect(0, 0, self.SIZE, self.SIZE)
-        rect.center = pos
-        rads = math.radians(self.angle)
-        renderer.draw_arc(self.COLOR, rect, self.ANGLE_FIX - rads - self.CURVE,
-                          self.ANGLE_FIX - rads + self.CURVE, width=3)
+    @classmethod
+    def batch_sprites(cls, store, slots, points, angles, atlas):
+        def render(bucket):
+            return atlas.arc(cls.COLOR, atlas.bucket_angle(bucket), cls.DIST_OFFSET, cls.SIZE, cls.CURVE, 3)
 
-        for arrow in self.arrows:
-            arrow.draw(renderer)
+        surfaces, offsets = atlas.table("bow", render).lookup(atlas.angle_buckets(angles))
+        return surfaces, points + offsets
 
     def activate(self):
         """Fire an arrow if we haven't recently"""
         if self.fire_timer <= 0:
-            # Fire an arrow
-            arrow = Arrow(self.pos, self.angle)
-            self.arrows.append(arrow)
+            Arrow.fire(self.pos, self.angle, self.damage, self.army)
             self.fire_timer = self.FIRING_SPEED
 
     def deactivate(self):
         # Can't stop a fired arrow
         pass
 
-    def hits_circle(self, other_pos, other_radius):
-        # Check if any arrow hits the circle
-        for arrow in self.arrows:
-            if arrow.hits_circle(other_pos, other_radius):
-                return True
-        return False
-
 
-class Arrow(Weapon):
-    """Arrow fired by a Bow"""
+class Arrow:
+    """Arrow fired by a Bow.
+    Arrows in flight are rows of a ProjectilePool shared by every bow, they are moved and hit things together.
+    """
     COLOR = Colors.brown
-
-    def __init__(self, pos, angle):
-        super(Arrow, self).__init__()
-        self.pos.x = pos.x
-        self.pos.y = pos.y
-        self.angle = angle
-        self.length = 9
-        self.width = 1
-        self.flight_speed = 250
-        self.max_distance = 400
-        self.distance = 0
-        self.hit = False  # has the arrow connected?
-
-    def needs_removal(self):
-        """Returns False after it has flown for a while"""
-        return self.distance > self.max_distance or self.hit
-
-    def update(self, delta):
-        norm = Vector2(0, -1)
-        norm.rotate_ip(self.angle)
-        dist = self.flight_speed * delta
-        new_pos = self.pos + norm * dist
-        self.pos.x = new_pos.x
-        self.pos.y = new_pos.y
-        # Keep track of how far the arrow has gone
-        self.distance += dist
-
-    def draw(self, renderer):
-        norm = Vector2(0, -1)
-        norm.rotate_ip(self.angle)
-        end_pos = self.pos + norm * self.length
-        renderer.draw_line(self.COLOR, self.pos, end_pos, self.width)
-
-    def hits_circle(self, other_pos, other_radius):
-        dist = other_pos.distance_to(self.pos)
-        self.hit = dist <= other_radius
-        return self.hit
+    LENGTH = 9
+    WIDTH = 1
+    FLIGHT_SPEED = 250
+    MAX_DISTANCE = 400
+
+    _pool = ProjectilePool()
+
+    @classmethod
+    def pool(cls):
+        """Gets the ProjectilePool holding every arrow in flight"""
+        return cls._pool
+
+    @classmethod
+    def fire(cls, pos, angle, damage, army=None):
+        """Launch an arrow from pos towards angle, it won't hit the given army"""
+        owner = army.my_id if army else ProjectilePool.NO_OWNER
+        return cls._pool.fire(pos, angle, cls.FLIGHT_SPEED, cls.MAX_DISTANCE, damage, owner)
+
+    @classmethod
+    def add_all_sprites(cls, sprites, atlas, interpolation):
+        """Add the (surface, top_left) pairs that draw every arrow in flight"""
+        pool = cls._pool
+        rows = pool.live_rows()
+        if not len(rows):
+            return
+        prev_pos = pool.prev_pos[rows]
+        points = (prev_pos + (pool.pos[rows] - prev_pos) * interpolation).astype(numpy.intp)
+
+        def render(bucket):
+            return atlas.line(cls.COLOR, atlas.bucket_angle(bucket), 0, cls.LENGTH, cls.WIDTH)
+
+        surfaces, offsets = atlas.table("arrow", render).lookup(atlas.angle_buckets(pool.angle[rows]))
+        sprites.extend(zip(surfaces.tolist(), (points + offsets).tolist()))